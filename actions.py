@@ -1,10 +1,42 @@
 """
-This module contains action class 
+This module contains action class
 to route each request method to associated db query
 """
 
-from validator import Body, validate_query_params
+from contextlib import nullcontext
+
+from validator import (Body, DeleteBody, PutBody, Batch,
+                       validate_query_params, encode_cursor)
+from serialization import columnar, records
 from db import RDB
+from cache import query_cache, make_cache_key, make_etag, etag_matches
+from tracing import tracer
+from exceptions import (InternalServerError, BadRequestError,
+                        NotAuthorizedError, NotFoundError)
+
+
+RESULT_MESSAGES = {
+    'POST': "Data has been inserted successfully.",
+    'PUT': "Data has been updated successfully.",
+    'DELETE': "Data has been removed successfully.",
+}
+
+# chunked writes that ran out of time before the last chunk
+PARTIAL_MESSAGES = {
+    'PUT': "Data has been partially updated, "
+           "send the request again with its continuation.",
+    'DELETE': "Data has been partially removed, "
+              "send the request again with its continuation.",
+}
+
+
+def session(rdb: RDB = None, **kwargs):
+    """
+    reuse the connection of a running batch, or open a new one
+    """
+    if rdb is not None:
+        return nullcontext(rdb)
+    return RDB(**kwargs)
 
 
 class Action:
@@ -12,26 +44,144 @@ class Action:
     action class for request methods
     """
     @staticmethod
-    def get(query_params) -> list:
-        query_params = validate_query_params(query_params)
-        with RDB() as rdb:
-            result = rdb.select(query_params)
-        return result
+    def get(query_params, rdb=None, headers=None,
+            client_id=None, context=None) -> dict:
+        with tracer.phase('validate'):
+            query_params = validate_query_params(query_params)
+        time_left = getattr(context, 'get_remaining_time_in_millis', None)
+        if query_params['format'] == 'ndjson':
+            with session(rdb, read_only=True, client_id=client_id,
+                         time_left=time_left) as rdb:
+                return rdb.export(query_params)
+        cache_key = make_cache_key(query_params)
+        with session(rdb, read_only=True, client_id=client_id,
+                     time_left=time_left) as rdb:
+            versions = None
+            if not rdb.dirty:
+                versions = rdb.table_versions()
+                etag = make_etag(cache_key, versions)
+                if etag_matches(headers, etag):
+                    return {'not_modified': True, 'etag': etag}
+                response = query_cache.get(cache_key, versions)
+                if response is not None:
+                    return response
+            if 'aggregates' in query_params:
+                response = {'result': rdb.aggregate(query_params)}
+            else:
+                response = Action.page(rdb, query_params)
+            if versions is not None:
+                response['etag'] = etag
+        if versions is not None:
+            query_cache.set(cache_key, versions, response)
+        return response
+
+    @staticmethod
+    def page(rdb, query_params) -> dict:
+        """
+        one page of products with its count and next cursor
+        """
+        columns, rows = rdb.select(query_params)
+        if query_params['format'] == 'columnar':
+            response = {'result': columnar(columns, rows)}
+        else:
+            response = {'result': records(columns, rows)}
+        if rdb.count_downgraded:
+            response['total_count'] = rdb.estimate_count(query_params)
+            response['count'] = 'estimate'
+        elif rdb.exact_count(query_params):
+            response['total_count'] = rdb.total_count
+        elif query_params.get('count') == 'estimate':
+            response['total_count'] = rdb.estimate_count(query_params)
+        if query_params['pagination'] == 'cursor':
+            response['next_cursor'] = None
+            if rows and len(rows) == query_params['limit']:
+                orderby = query_params['orderby']
+                response['next_cursor'] = encode_cursor(
+                    orderby,
+                    rows[-1][columns.index(orderby)],
+                    rows[-1][columns.index('id')])
+        return response
 
     @staticmethod
-    def put(data) -> None:
-        body = Body(**data).model_dump()
-        with RDB() as rdb:
+    def put(data, rdb=None, client_id=None, context=None) -> dict:
+        with tracer.phase('validate'):
+            body = PutBody(**data).model_dump()
+        if rdb is None and RDB.needs_chunks(body):
+            return Action.chunked(body, 'PUT', client_id, context)
+        with session(rdb, client_id=client_id) as rdb:
             rdb.update(body)
+        return dict()
 
     @staticmethod
-    def post(data) -> None:
-        body = Body(**data).model_dump()
-        with RDB() as rdb:
+    def post(data, rdb=None, client_id=None) -> None:
+        with tracer.phase('validate'):
+            body = Body(**data).model_dump()
+        with session(rdb, client_id=client_id) as rdb:
             rdb.insert(body)
 
     @staticmethod
-    def delete(data) -> None:
-        body = Body(**data).model_dump()
-        with RDB() as rdb:
+    def delete(data, rdb=None, client_id=None, context=None) -> dict:
+        with tracer.phase('validate'):
+            body = DeleteBody(**data).model_dump()
+        if rdb is None and RDB.needs_chunks(body):
+            return Action.chunked(body, 'DELETE', client_id, context)
+        with session(rdb, client_id=client_id) as rdb:
             rdb.delete(body)
+        return dict()
+
+    @staticmethod
+    def chunked(body, method, client_id=None, context=None) -> dict:
+        """
+        large PUT and DELETE bodies commit chunk by chunk and stop
+        before the lambda timeout, batches never run chunked
+        """
+        time_left = getattr(context, 'get_remaining_time_in_millis', None)
+        with RDB(client_id=client_id) as rdb:
+            response = rdb.chunked(body, method, time_left)
+        if response['continuation']:
+            response['result'] = PARTIAL_MESSAGES[method]
+        return response
+
+    @staticmethod
+    def batch(data, client_id=None, context=None) -> dict:
+        """
+        run many operations on one connection and one transaction,
+        atomic batches stop and roll back at the first failure
+        """
+        with tracer.phase('validate'):
+            batch = Batch(**data).model_dump()
+        atomic = batch['atomic']
+        results = list()
+        time_left = getattr(context, 'get_remaining_time_in_millis', None)
+        with RDB(client_id=client_id, time_left=time_left) as rdb:
+            for index, operation in enumerate(batch['operations']):
+                method = operation['method']
+                if not atomic:
+                    rdb.begin_savepoint(f'operation_{index}')
+                try:
+                    if method == 'GET':
+                        result = Action.get(
+                            operation['queryParams'] or dict(), rdb=rdb)
+                    else:
+                        getattr(Action, method.lower())(
+                            operation['body'] or dict(), rdb=rdb)
+                        result = {'result': RESULT_MESSAGES[method]}
+                except (BadRequestError, NotAuthorizedError,
+                        NotFoundError, InternalServerError) as e:
+                    results.append({'is_success': False, 'error': str(e)})
+                    if atomic:
+                        rdb.do_roll_back()
+                        for previous in results[:-1]:
+                            previous['rolled_back'] = True
+                        break
+                    rdb.rollback_savepoint()
+                    rdb.release_savepoint()
+                    continue
+                if not atomic:
+                    rdb.release_savepoint()
+                results.append({'is_success': True, **result})
+        return {
+            'results': results,
+            'is_success': all(result['is_success'] for result in results)
+            and len(results) == len(batch['operations']),
+        }
@@ -0,0 +1,86 @@
+"""
+measure import time, init phase and first invocation of the handler
+in fresh interpreters, against a local stand-in postgres
+
+    BENCH_DSN="dbname=bench" python benchmarks/bench_cold_start.py
+"""
+
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+from common import ROOT, BENCH_DSN, bench_connection, seed, report
+
+CHILD = """
+import sys
+import json
+import time
+
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.lambda_handler({'method': 'GET', 'queryParams': {}}, None)
+invoked = time.perf_counter()
+print(json.dumps({
+    'init_ms': (imported - start) * 1000,
+    'first_invocation_ms': (invoked - imported) * 1000,
+    'secrets_manager_loaded': 'aws_secretsmanager_caching' in sys.modules,
+    'bulk_loaded': 'bulk' in sys.modules,
+}))
+"""
+
+
+def run(preload: str, repeat: int) -> dict:
+    env = dict(os.environ, DATABASE_DSN=BENCH_DSN, PRELOAD=preload)
+    samples = list()
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD],
+            cwd=ROOT, env=env, check=True,
+            capture_output=True, text=True,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'init_ms': round(statistics.median(
+            s['init_ms'] for s in samples), 2),
+        'first_invocation_ms': round(statistics.median(
+            s['first_invocation_ms'] for s in samples), 2),
+        'lazy_modules_loaded': any(
+            s['secrets_manager_loaded'] or s['bulk_loaded']
+            for s in samples),
+    }
+
+
+def import_profile(limit: int = 15):
+    """
+    slowest imports of main, from python -X importtime
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=ROOT, env=dict(os.environ, PRELOAD='0'),
+        capture_output=True, text=True,
+    ).stderr
+    rows = list()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), module.strip()))
+    for cumulative, module in sorted(rows, reverse=True)[:limit]:
+        print(f"  {module:<40} {cumulative / 1000:.2f} ms")
+
+
+def main(repeat: int = 10):
+    seed(bench_connection())
+    report("cold start (median of %d fresh interpreters)" % repeat, {
+        'no preload, work on first request': run('0', repeat),
+        'preload in init phase': run('1', repeat),
+    })
+    print("slowest imports")
+    import_profile()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+compare filter parsing and validation time per request,
+regex + literal_eval + two Filter models (before)
+against the single-pass tokenizer with its LRU cache (after)
+
+    python benchmarks/bench_filters.py
+"""
+
+import re
+import ast
+
+from common import timeit, report
+
+from validator import Filter, parse_filters, tokenize_filters
+
+FILTERS = (
+    "&price__gte=10.5*&price__lt=250*&category_id__in=(1,2,3,4,5)*"
+    "|name__like=phone*|description__like=wireless*"
+    "|category_name__nin=('archived','hidden')*"
+)
+
+
+def legacy_parse_filters(filters: str) -> dict:
+    def list_to_dict(lst: list) -> dict:
+        dct = dict()
+        for item in lst:
+            key_value = item.split('=')
+            if key_value[0].endswith('__in') or \
+                    key_value[0].endswith('__nin'):
+                dct[key_value[0]] = ast.literal_eval(key_value[1])
+            else:
+                dct[key_value[0]] = key_value[1]
+        return dct
+
+    and_filters = Filter(**list_to_dict(
+        re.findall(r'&(.*?)\*', filters))).model_dump(exclude_none=True)
+    or_filters = Filter(**list_to_dict(
+        re.findall(r'\|(.*?)\*', filters))).model_dump(exclude_none=True)
+    parsed = {'and__'+k: v for k, v in and_filters.items()}
+    parsed.update({'or__'+k: v for k, v in or_filters.items()})
+    return parsed
+
+
+def uncached_parse_filters(filters: str) -> dict:
+    return parse_filters.__wrapped__(filters)
+
+
+def main():
+    report("parse + validate filters per request", {
+        'regex + literal_eval (before)': timeit(
+            lambda: legacy_parse_filters(FILTERS), repeat=5000),
+        'tokenizer only': timeit(
+            lambda: tokenize_filters(FILTERS), repeat=5000),
+        'tokenizer + validation, cache miss': timeit(
+            lambda: uncached_parse_filters(FILTERS), repeat=5000),
+        'tokenizer + validation, cache hit (after)': timeit(
+            lambda: parse_filters(FILTERS), repeat=5000),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+compare time and peak memory per 10k fetched rows of
+RealDictCursor rows copied with dict(record) (before),
+tuple rows turned into dicts over one column tuple (after, json)
+and tuple rows left as they are (after, columnar)
+
+    BENCH_DSN="dbname=bench" python benchmarks/bench_rows.py
+"""
+
+import tracemalloc
+
+from psycopg2.extras import RealDictCursor
+
+from common import bench_connection, seed, timeit, report
+
+from serialization import records
+
+ROWS = 10000
+QUERY = (
+    "SELECT products.id, products.name, products.category_id, "
+    "products.price, categories.name AS category_name, "
+    "categories.description "
+    "FROM products LEFT JOIN categories "
+    "ON products.category_id = categories.id "
+    "ORDER BY products.id LIMIT %s;"
+)
+
+
+def peak_memory(func) -> int:
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    connection = bench_connection()
+    seed(connection)
+    dict_cursor = connection.cursor(cursor_factory=RealDictCursor)
+    tuple_cursor = connection.cursor()
+
+    def dict_rows():
+        dict_cursor.execute(QUERY, (ROWS,))
+        return [dict(record) for record in dict_cursor.fetchall()]
+
+    def tuple_records():
+        tuple_cursor.execute(QUERY, (ROWS,))
+        columns = tuple(column.name for column in tuple_cursor.description)
+        return records(columns, tuple_cursor.fetchall())
+
+    def tuple_rows():
+        tuple_cursor.execute(QUERY, (ROWS,))
+        return tuple_cursor.fetchall()
+
+    results = dict()
+    for name, func in (
+            ('RealDictCursor + dict(record) (before)', dict_rows),
+            ('tuple cursor + shared columns (after)', tuple_records),
+            ('tuple cursor, columnar (after)', tuple_rows)):
+        results[name] = {
+            'peak_bytes': peak_memory(func),
+            **timeit(func, repeat=50),
+        }
+    connection.rollback()
+    report(f"fetch {ROWS} rows", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+compare select composition time and end-to-end latency
+with and without the compiled statement cache and prepared statements
+
+    BENCH_DSN="dbname=bench" python benchmarks/bench_select.py
+"""
+
+from common import bench_connection, seed, timeit, report
+
+import db
+from db import RDB, statement_cache
+from validator import validate_query_params
+
+QUERY_PARAMS = {
+    'filters': "&price__gt=100*&category_id__in=(1,2,3,4)*|name__like=duct 1*",
+    'limit': 20,
+    'orderby': 'price',
+}
+
+
+def main():
+    connection = bench_connection()
+    seed(connection)
+    query_params = validate_query_params(dict(QUERY_PARAMS))
+
+    with RDB() as rdb:
+        shape = rdb.select_shape(query_params)
+
+        def compose():
+            rdb.build_select(query_params).as_string(rdb.cursor)
+
+        def compiled():
+            rdb.compile(shape, rdb.build_select, query_params)
+
+        composition = {
+            'compose every request (before)': timeit(compose),
+            'compiled statement cache (after)': timeit(compiled),
+        }
+
+        def select_text():
+            rdb.select(query_params)
+
+        db.USE_PREPARED_STATEMENTS = False
+        statement_cache.clear()
+        text = timeit(select_text, repeat=500)
+        db.USE_PREPARED_STATEMENTS = True
+        prepared = timeit(select_text, repeat=500)
+
+        def select_uncached():
+            statement_cache.clear()
+            rdb.select(query_params)
+
+        db.USE_PREPARED_STATEMENTS = False
+        before = timeit(select_uncached, repeat=500)
+
+    report("select composition", composition)
+    report("select end-to-end", {
+        'compose + text query (before)': before,
+        'cached + text query': text,
+        'cached + prepared statement (after)': prepared,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+compare payload bytes and serialize time of a GET page
+as a list of row dicts (before) and as format=columnar (after),
+with the stdlib json encoder and orjson when it is installed
+
+    python benchmarks/bench_serialize.py
+"""
+
+import json
+
+from common import timeit, report
+
+import serialization
+from serialization import dumps, columnar
+
+COLUMNS = ['id', 'name', 'category_id', 'price',
+           'category_name', 'description']
+
+
+def make_rows(count: int) -> list:
+    return [
+        (i, f'product {i}', i % 100, round(i * 0.37, 2),
+         f'category {i % 100}', f'description of category {i % 100}')
+        for i in range(1, count + 1)
+    ]
+
+
+def main():
+    encoders = {'json': lambda value: json.dumps(value, default=str)}
+    encoders['compact'] = dumps
+    if serialization.orjson is None:
+        print("orjson is not installed, compact uses the stdlib encoder")
+    for count in (100, 1000, 10000):
+        rows = make_rows(count)
+        dict_response = {'result': [dict(zip(COLUMNS, row)) for row in rows]}
+        columnar_response = {'result': columnar(COLUMNS, rows)}
+        repeat = max(10, 100000 // count)
+        results = dict()
+        for shape, response in (('dicts', dict_response),
+                                ('columnar', columnar_response)):
+            for name, encode in encoders.items():
+                results[f'{shape} + {name}'] = {
+                    'bytes': len(encode(response)),
+                    **timeit(lambda: encode(response), repeat=repeat),
+                }
+        report(f"{count} rows", results)
+
+
+if __name__ == '__main__':
+    main()
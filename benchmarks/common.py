@@ -0,0 +1,81 @@
+"""
+This module contains helpers shared by benchmarks,
+they run against a local stand-in postgres given by BENCH_DSN
+"""
+
+import os
+import sys
+import time
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+BENCH_DSN = os.environ.get(
+    'BENCH_DSN', 'dbname=postgres user=postgres host=localhost')
+
+
+def bench_connection():
+    """
+    open a connection to the stand-in postgres
+    and hand it to the module level connection manager
+    """
+    from psycopg2 import connect
+    import db
+
+    connection = connect(BENCH_DSN)
+    db.connection_manager.connection = connection
+    db.connection_manager.prepared = set()
+    return connection
+
+
+def seed(connection, products: int = 100000, categories: int = 100):
+    """
+    create and fill catalog tables once
+    """
+    from schema import migrate
+
+    migrate(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM products;")
+        if cursor.fetchone()[0] < products:
+            cursor.execute(
+                """
+                INSERT INTO categories (name, description)
+                SELECT 'category ' || i, 'description of category ' || i
+                FROM generate_series(1, %(categories)s) AS i;
+                INSERT INTO products (name, category_id, price)
+                SELECT 'product ' || i,
+                       (SELECT min(id) FROM categories) + i %% %(categories)s,
+                       round((random() * 1000)::numeric, 2)
+                FROM generate_series(1, %(products)s) AS i;
+                ANALYZE categories;
+                ANALYZE products;
+                """,
+                {'products': products, 'categories': categories}
+            )
+    connection.commit()
+
+
+def timeit(func, repeat: int = 1000) -> dict:
+    """
+    per call timings in microseconds
+    """
+    samples = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        'mean_us': round(statistics.mean(samples), 2),
+        'p50_us': round(samples[len(samples) // 2], 2),
+        'p99_us': round(samples[int(len(samples) * 0.99) - 1], 2),
+    }
+
+
+def report(title: str, rows: dict):
+    print(title)
+    for name, result in rows.items():
+        print(f"  {name:<40} {result}")
@@ -0,0 +1,67 @@
+"""
+This module contains helpers to stream rows
+into postgres COPY without building the whole payload in memory
+"""
+
+import io
+import csv
+
+from itertools import islice
+
+
+def chunked(iterable, size: int):
+    """
+    yield lists of at most size items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_csv(rows):
+    """
+    yield one csv line per row
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+class IteratorFile(io.TextIOBase):
+    """
+    read-only file over an iterator of strings,
+    only as much text as COPY asks for is materialized
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            chunk, self._buffer = self._buffer, ''
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size: int = -1) -> str:
+        if not self._buffer:
+            self._buffer = next(self._lines, '')
+        line, sep, rest = self._buffer.partition('\n')
+        self._buffer = rest
+        return line + sep
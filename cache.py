@@ -0,0 +1,124 @@
+"""
+This module contains in-process caches
+that survive between warm lambda invocations
+"""
+
+import os
+import json
+import time
+import hashlib
+
+from collections import OrderedDict
+
+
+def make_cache_key(query_params: dict) -> str:
+    """
+    normalize validated query params into a cache key,
+    so equivalent requests share one entry
+    """
+    normalized = dict()
+    for k, v in query_params.items():
+        if k.endswith('__in') or k.endswith('__nin'):
+            # membership filters do not depend on item order
+            v = sorted(set(v))
+        normalized[k] = v
+    return json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+
+
+def make_etag(cache_key: str, versions: tuple) -> str:
+    """
+    weak etag of a normalized query at the current table versions
+    """
+    digest = hashlib.sha1(
+        (cache_key + repr(versions)).encode('utf-8')).hexdigest()
+    return 'W/"' + digest + '"'
+
+
+def etag_matches(headers: dict, etag: str) -> bool:
+    """
+    whether the If-None-Match request header already names this etag
+    """
+    if_none_match = None
+    for name, value in (headers or dict()).items():
+        if name.lower() == 'if-none-match':
+            if_none_match = value
+            break
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(',')}
+    return '*' in candidates or etag in candidates or \
+        etag[2:] in candidates
+
+
+class QueryCache:
+    """
+    bounded LRU + TTL cache, entries are valid
+    only for the table versions they were read at
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key: str, versions: tuple):
+        """
+        cached value or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        expires_at, entry_versions, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.counters['expirations'] += 1
+            self.counters['misses'] += 1
+            return None
+        if entry_versions != versions:
+            del self.entries[key]
+            self.counters['invalidations'] += 1
+            self.counters['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return value
+
+    def set(self, key: str, versions: tuple, value):
+        """
+        store a value, evicting the least recently used entries
+        """
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, versions, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        hit/miss/eviction counters
+        """
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {
+            **self.counters,
+            'size': len(self.entries),
+            'hit_rate': self.counters['hits'] / lookups if lookups else 0.0,
+        }
+
+
+query_cache = QueryCache(
+    maxsize=int(os.environ.get('QUERY_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('QUERY_CACHE_TTL', 30)),
+)
@@ -2,53 +2,571 @@
 This module contains RDS queries
 """
 
-from psycopg2 import sql, connect
-from psycopg2.extras import RealDictCursor
+import os
+import re
+import json
+import time
+import random
+import hashlib
 
-from aws_secretsmanager_caching import SecretCache, InjectKeywordedSecretString
+from collections import OrderedDict
 
-from exceptions import InternalServerError, NotFoundError
+from psycopg2 import sql, connect, OperationalError, InterfaceError
+from psycopg2.errors import ForeignKeyViolation, QueryCanceled
+from psycopg2.extensions import (TRANSACTION_STATUS_IDLE,
+                                 TRANSACTION_STATUS_UNKNOWN)
 
+from validator import encode_cursor, encode_continuation, decode_continuation
+from serialization import dumps, records
+from tracing import tracer, traced
+from exceptions import InternalServerError, BadRequestError, NotFoundError
 
-def get_secret_cache():
-    global cache
-    if not cache:
-        cache = SecretCache()
-    return cache
 
+# stand-in database for local runs, skips secrets manager entirely
+DATABASE_DSN = os.environ.get('DATABASE_DSN')
 
-def get_rds_credentials(secret_cache):
-    @InjectKeywordedSecretString(
-        secret_id="development/rds/postgresql",
-        cache=secret_cache,
-        db_name="dbname",
-        db_pass="password",
-        db_user="username",
-        endpoint="host",
-        port="port",
-    )
-    def get_credentials(db_name, db_pass, db_user, endpoint, port):
-        return db_name, db_pass, db_user, endpoint, port
 
-    return get_credentials()
+SECRET_ID = os.environ.get('DB_SECRET_ID', 'development/rds/postgresql')
+# seconds the parsed secret is used without asking the secret cache again
+CREDENTIALS_TTL = float(os.environ.get('DB_CREDENTIALS_TTL', 300))
+# seconds to wait for a new connection, an unreachable endpoint has to fail
+# well inside the lambda timeout and the 10 second init phase
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 3))
+
+
+def is_auth_failure(error: OperationalError) -> bool:
+    """
+    whether a connect error is a rejected password, e.g. after rotation
+    """
+    return error.pgcode == '28P01' or \
+        'password authentication failed' in str(error)
+
+
+class CredentialsProvider:
+    """
+    keep the parsed database secret in memory for a ttl,
+    warm requests do no secrets manager work at all
+    """
+
+    def __init__(self, secret_id: str, ttl: float = 300):
+        self.secret_id = secret_id
+        self.ttl = ttl
+        self.secret_cache = None
+        self.credentials = None
+        self.expires_at = 0.0
+        self.counters = {
+            'hits': 0,
+            'fetches': 0,
+            'refreshes': 0,
+        }
+
+    @traced('secret')
+    def fetch(self, refresh: bool = False) -> dict:
+        """
+        read and parse the secret, refresh skips the secret cache
+        """
+        if self.secret_cache is None:
+            # imported on first connect only, keeps it out of the import phase
+            from aws_secretsmanager_caching import SecretCache
+
+            self.secret_cache = SecretCache()
+        if refresh:
+            self.secret_cache.refresh_secret_now(self.secret_id)
+        secret = json.loads(
+            self.secret_cache.get_secret_string(self.secret_id))
+        return {
+            'database': secret['dbname'],
+            'password': secret['password'],
+            'user': secret['username'],
+            'host': secret['host'],
+            'port': secret['port'],
+        }
+
+    def get(self, refresh: bool = False) -> dict:
+        """
+        connect kwargs, fetched again once the ttl has passed
+        """
+        if not refresh and self.credentials is not None \
+                and time.monotonic() < self.expires_at:
+            self.counters['hits'] += 1
+            return self.credentials
+        self.credentials = self.fetch(refresh=refresh)
+        self.expires_at = time.monotonic() + self.ttl
+        self.counters['refreshes' if refresh else 'fetches'] += 1
+        return self.credentials
+
+
+credentials_provider = CredentialsProvider(
+    SECRET_ID, ttl=CREDENTIALS_TTL)
+
+
+class ConnectionManager:
+    """
+    keep one postgres connection alive between warm invocations
+    """
+
+    def __init__(self, ping_interval: float = 30, host: str = None):
+        self.connection = None
+        # endpoint replacing the secret host, set for reader endpoints
+        self.host = host
+        # idle seconds after which the connection is pinged before reuse
+        self.ping_interval = ping_interval
+        self.last_used = 0.0
+        # names of statements prepared on the current connection
+        self.prepared = set()
+        self.counters = {
+            'connects': 0,
+            'reuses': 0,
+            'reconnects': 0,
+        }
+
+    @traced('connect')
+    def connect(self):
+        """
+        open a new connection
+        """
+        overrides = {'connect_timeout': DB_CONNECT_TIMEOUT}
+        if self.host:
+            overrides['host'] = self.host
+        if DATABASE_DSN:
+            self.connection = connect(DATABASE_DSN, **overrides)
+        else:
+            try:
+                self.connection = connect(
+                    **{**credentials_provider.get(), **overrides})
+            except OperationalError as e:
+                if not is_auth_failure(e):
+                    raise
+                # the secret was rotated, retry once with a fresh copy
+                print("Error-Connection Auth", "*"*5, str(e))
+                self.connection = connect(**{
+                    **credentials_provider.get(refresh=True), **overrides})
+        self.prepared = set()
+        self.counters['connects'] += 1
+
+    def close(self):
+        """
+        close the connection, ignoring a dead socket
+        """
+        if self.connection is not None and not self.connection.closed:
+            try:
+                self.connection.close()
+            except (OperationalError, InterfaceError):
+                pass
+        self.connection = None
+
+    def is_healthy(self) -> bool:
+        """
+        cheap health check, only hits the server after an idle period
+        """
+        if self.connection is None or self.connection.closed:
+            return False
+        status = self.connection.info.transaction_status
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            # leftovers of a previous request must never leak
+            if status != TRANSACTION_STATUS_IDLE:
+                self.connection.rollback()
+            if time.monotonic() - self.last_used < self.ping_interval:
+                return True
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            self.connection.rollback()
+            return True
+        except (OperationalError, InterfaceError) as e:
+            print("Error-Connection Health Check", "*"*5, str(e))
+            return False
+
+    def acquire(self):
+        """
+        return a ready connection, reconnecting if the old one is gone
+        """
+        if self.connection is None:
+            self.connect()
+        elif self.is_healthy():
+            self.counters['reuses'] += 1
+        else:
+            self.close()
+            self.connect()
+            self.counters['reconnects'] += 1
+        return self.connection
+
+    def release(self, commit: bool = True):
+        """
+        end the request transaction but keep the connection open
+        """
+        if self.connection is None or self.connection.closed:
+            self.connection = None
+            return
+        try:
+            if commit:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        except (OperationalError, InterfaceError) as e:
+            print("Error-Connection Release", "*"*5, str(e))
+            self.close()
+            if commit:
+                raise InternalServerError()
+        self.last_used = time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        reuse and reconnect counters
+        """
+        acquired = self.counters['connects'] + self.counters['reuses']
+        return {
+            **self.counters,
+            'hit_rate': self.counters['reuses'] / acquired if acquired else 0.0,
+        }
+
+
+DB_PING_INTERVAL = float(os.environ.get('DB_PING_INTERVAL', 30))
+# comma separated reader hosts, GET falls back to the writer without them
+DB_READER_ENDPOINTS = [
+    host.strip()
+    for host in os.environ.get('DB_READER_ENDPOINTS', '').split(',')
+    if host.strip()
+]
+# seconds a reader that failed to connect is skipped
+DB_READER_COOLDOWN = float(os.environ.get('DB_READER_COOLDOWN', 30))
+# seconds a client reads from the writer after its last write, 0 disables
+READ_YOUR_WRITES_WINDOW = float(
+    os.environ.get('READ_YOUR_WRITES_WINDOW', 0))
+
+
+class ConnectionRouter:
+    """
+    send reads to a healthy reader endpoint and everything else,
+    including reads of clients that just wrote, to the writer
+    """
+
+    def __init__(self, writer: ConnectionManager, readers: list,
+                 cooldown: float = 30, pin_window: float = 0):
+        self.writer = writer
+        self.readers = readers
+        self.cooldown = cooldown
+        self.pin_window = pin_window
+        # stay on one reader while it is healthy, keeps one warm connection
+        self.current = random.randrange(len(readers)) if readers else 0
+        self.failed_until = dict()
+        self.pinned = dict()
+        self.counters = {
+            'reader': 0,
+            'writer': 0,
+            'pinned': 0,
+            'fallbacks': 0,
+        }
+
+    def pin(self, client_id):
+        """
+        route the reads of a client to the writer for the pin window
+        """
+        if self.pin_window > 0 and client_id:
+            now = time.monotonic()
+            # pins are kept in expiry order, expired ones leave from the front
+            while self.pinned:
+                oldest = next(iter(self.pinned))
+                if self.pinned[oldest] >= now:
+                    break
+                del self.pinned[oldest]
+            self.pinned.pop(client_id, None)
+            self.pinned[client_id] = now + self.pin_window
+
+    def is_pinned(self, client_id) -> bool:
+        expires_at = self.pinned.get(client_id)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self.pinned[client_id]
+            return False
+        return True
+
+    def acquire_reader(self):
+        """
+        first reader that is not cooling down and connects, or None
+        """
+        now = time.monotonic()
+        for step in range(len(self.readers)):
+            index = (self.current + step) % len(self.readers)
+            reader = self.readers[index]
+            if self.failed_until.get(index, 0) > now:
+                continue
+            try:
+                reader.acquire()
+            except (OperationalError, InterfaceError) as e:
+                print("Error-Connection Reader", "*"*5, reader.host, str(e))
+                reader.close()
+                self.failed_until[index] = now + self.cooldown
+                continue
+            self.current = index
+            return reader
+        return None
+
+    def acquire(self, read_only: bool = False, client_id=None):
+        """
+        connection manager serving the request, its connection acquired
+        """
+        if read_only and self.readers:
+            if self.is_pinned(client_id):
+                self.counters['pinned'] += 1
+            else:
+                reader = self.acquire_reader()
+                if reader is not None:
+                    self.counters['reader'] += 1
+                    return reader
+                self.counters['fallbacks'] += 1
+        self.counters['writer'] += 1
+        self.writer.acquire()
+        return self.writer
+
+    def stats(self) -> dict:
+        """
+        routing counters and per endpoint connection counters
+        """
+        return {
+            **self.counters,
+            'writer_connections': self.writer.stats(),
+            'reader_connections': {
+                reader.host: reader.stats() for reader in self.readers
+            },
+        }
+
+
+connection_manager = ConnectionManager(ping_interval=DB_PING_INTERVAL)
+connection_router = ConnectionRouter(
+    connection_manager,
+    [
+        ConnectionManager(ping_interval=DB_PING_INTERVAL, host=host)
+        for host in DB_READER_ENDPOINTS
+    ],
+    cooldown=DB_READER_COOLDOWN,
+    pin_window=READ_YOUR_WRITES_WINDOW,
+)
+
+
+USE_PREPARED_STATEMENTS = os.environ.get('PREPARED_STATEMENTS', '1') == '1'
+STATEMENT_CACHE_SIZE = int(os.environ.get('STATEMENT_CACHE_SIZE', 128))
+
+
+class CompiledStatement:
+    """
+    sql text compiled once per query shape,
+    runnable as text or as a server-side prepared statement
+    """
+
+    def __init__(self, shape: tuple, text: str):
+        self.name = 'stmt_' + hashlib.sha1(
+            repr(shape).encode('utf-8')).hexdigest()[:16]
+        self.text = text
+        # result column names, read from the first execution
+        self.columns = None
+        self.param_names = list()
+        self.prepare_text = re.sub(
+            r'%\((\w+)\)s', self._positional, text)
+
+    def _positional(self, match) -> str:
+        param = match.group(1)
+        if param not in self.param_names:
+            self.param_names.append(param)
+        return '$' + str(self.param_names.index(param) + 1)
+
+    def bind(self, query_params: dict) -> dict:
+        """
+        parameters used by the statement, sequences as arrays for ANY/ALL
+        """
+        return {
+            name: list(query_params[name])
+            if isinstance(query_params[name], tuple)
+            else query_params[name]
+            for name in self.param_names
+        }
+
+
+statement_cache = OrderedDict()
+
+# planner cost a GET may reach, 0 disables the EXPLAIN check
+QUERY_COST_BUDGET = float(os.environ.get('QUERY_COST_BUDGET', 0))
+# lambda time kept back from the statement timeout to answer the request
+STATEMENT_TIMEOUT_RESERVE_MS = int(
+    os.environ.get('STATEMENT_TIMEOUT_RESERVE_MS', 300))
+MIN_STATEMENT_TIMEOUT_MS = 100
+
+# (statement name, limit and offset magnitudes) -> planner total cost
+cost_cache = OrderedDict()
+
+
+# text search configuration of the generated search_vector columns
+SEARCH_CONFIG = 'english'
+
+# response field -> (table, column) it is read from
+COLUMNS = {
+    'id': ('products', 'id'),
+    'name': ('products', 'name'),
+    'category_id': ('products', 'category_id'),
+    'price': ('products', 'price'),
+    'category_name': ('categories', 'name'),
+    'description': ('categories', 'description'),
+}
+
+# orderby columns that can hold NULL, products whose category was deleted
+# while the foreign key still said ON DELETE SET NULL
+NULLABLE_COLUMNS = ('category_id',)
+
+# categories tables above this many rows are joined instead of cached
+CATEGORY_CACHE_MAX_ROWS = int(os.environ.get('CATEGORY_CACHE_MAX_ROWS', 10000))
+# category filters the cache can answer, text order and search need postgres
+CATEGORY_CACHE_OPERATORS = ('eq', 'ne', 'in', 'nin', 'like')
+
+
+def like_pattern(pattern: str):
+    """
+    regex of a LIKE pattern, a backslash escapes the next character
+    """
+    parts = list()
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        if char == '\\' and i + 1 < n:
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(parts), re.DOTALL)
+
+
+class CategoryCache:
+    """
+    categories by id as (name, description), loaded once per
+    categories version, so GET skips the join and existence
+    checks skip the round trip
+    """
+    COLUMNS = ('name', 'description')
+
+    def __init__(self, max_rows: int = 10000):
+        self.max_rows = max_rows
+        self.version = None
+        # None while unloaded or when the table is too big to cache
+        self.categories = None
+        self.counters = {
+            'hits': 0,
+            'loads': 0,
+        }
+
+    def get(self, rdb, version):
+        """
+        categories at the given version, reloaded when it moved
+        """
+        if self.max_rows <= 0 or version is None:
+            return None
+        if version == self.version:
+            self.counters['hits'] += 1
+            return self.categories
+        rdb.execute(
+            sql.SQL(
+                "SELECT {_id}, {name}, {description} FROM {categories} "
+                "LIMIT %(limit)s;"
+            ).format(
+                _id=sql.Identifier('id'),
+                name=sql.Identifier('name'),
+                description=sql.Identifier('description'),
+                categories=sql.Identifier('categories'),
+            ),
+            {'limit': self.max_rows + 1})
+        rows = rdb.cursor.fetchall()
+        self.counters['loads'] += 1
+        self.version = version
+        self.categories = None
+        if len(rows) <= self.max_rows:
+            self.categories = {row[0]: row[1:] for row in rows}
+        return self.categories
+
+    def match(self, field: str, opr: str, value) -> list:
+        """
+        ids of categories a category_name or description filter accepts
+        """
+        index = self.COLUMNS.index(COLUMNS[field][1])
+        if opr == 'like':
+            pattern = like_pattern(value)
+        elif opr in ('in', 'nin'):
+            value = set(value)
+        ids = list()
+        for _id, category in self.categories.items():
+            if opr == 'like':
+                accepted = pattern.fullmatch(category[index]) is not None
+            elif opr == 'eq':
+                accepted = category[index] == value
+            elif opr == 'ne':
+                accepted = category[index] != value
+            elif opr == 'in':
+                accepted = category[index] in value
+            else:
+                accepted = category[index] not in value
+            if accepted:
+                ids.append(_id)
+        return ids
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'size': len(self.categories or ()),
+        }
+
+
+category_cache = CategoryCache(max_rows=CATEGORY_CACHE_MAX_ROWS)
+
+
+# request bodies with at least this many rows are written with COPY
+BULK_INSERT_THRESHOLD = int(os.environ.get('BULK_INSERT_THRESHOLD', 1000))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 5000))
+
+# exports stop below the 6 MB lambda response limit, counted as the
+# escaped ascii json the runtime sends, not as characters
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', 4 * 1024 * 1024))
+EXPORT_ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', 2000))
+CATEGORY_IN_USE = "Categories still referenced by products can't be deleted!"
+
+# PUT and DELETE bodies above this many rows run as committed chunks
+WRITE_CHUNK_SIZE = int(os.environ.get('WRITE_CHUNK_SIZE', 1000))
+# chunked writes stop and hand out a continuation below this much time left
+CHUNK_TIME_RESERVE_MS = int(os.environ.get('CHUNK_TIME_RESERVE_MS', 1000))
 
 
 class RDB:
-    def __init__(self):
-        rds_creds = get_rds_credentials(
-            secret_cache=get_secret_cache())
-        self.connection = connect(
-            database=rds_creds[0],
-            password=rds_creds[1],
-            user=rds_creds[2],
-            host=rds_creds[3],
-            port=rds_creds[4],
-        )
-        self.cursor = self.connection.cursor(
-            cursor_factory=RealDictCursor)
+    def __init__(self, read_only: bool = False, client_id=None,
+                 time_left=None):
+        with tracer.phase('acquire'):
+            self.manager = connection_router.acquire(
+                read_only=read_only, client_id=client_id)
+        self.connection = self.manager.connection
+        self.client_id = client_id
+        # remaining lambda milliseconds, bounds the statement timeout
+        self.time_left = time_left
+        # plain tuple rows, dicts are only built at the response boundary
+        self.cursor = self.connection.cursor()
         self.and_filters = list()
         self.or_filters = list()
         self.filters = list()
+        # total of the last select when an exact count was asked for
+        self.total_count = None
+        # set once this transaction has written, its reads are not cacheable
+        self.dirty = False
+        # errors roll back to this savepoint instead of the whole transaction
+        self.savepoint = None
+        # table versions this transaction read last
+        self.versions = None
+        # a connection lost before the first statement is replaced once
+        self.started = False
+        self.reconnected = False
+        # set when the cost guard replaced an exact count by an estimate
+        self.count_downgraded = False
         self.comparison_operators = {
             '__eq': ' = ',
             '__ne': ' != ',
@@ -56,70 +574,251 @@ class RDB:
             '__gte': ' >= ',
             '__lt': ' < ',
             '__lte': ' <= ',
-            '__in': ' IN ',
-            '__nin': ' NOT IN ',
+            '__in': ' = ANY',
+            '__nin': ' <> ALL',
             '__like': ' LIKE ',
+            '__search': ' @@ ',
         }
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *args, **kwargs):
+    def __exit__(self, exc_type, *args, **kwargs):
         print("Query", "*"*5, self.cursor.query)
-        if not self.connection.closed:
-            self.connection.commit()
-            self.connection.close()
+        if not self.cursor.closed:
+            self.cursor.close()
+        self.manager.release(commit=exc_type is None)
+        if exc_type is None and self.dirty:
+            connection_router.pin(self.client_id)
 
     def do_roll_back(self):
-        self.connection.rollback()
-        self.connection.close()
+        if self.savepoint:
+            self.rollback_savepoint()
+        else:
+            self.manager.release(commit=False)
 
-    def operator(self, attribute: str) -> list:
+    def can_reconnect(self, cursor) -> bool:
         """
-        generate condition based on attribute operator
+        a dead connection, e.g. after a failover, is replaced transparently
+        only while the request has run nothing on it yet
+        """
+        return not self.started and not self.reconnected and \
+            cursor is self.cursor and bool(self.connection.closed)
+
+    def reconnect(self, error: Exception):
+        print("Error-Connection Lost", "*"*5, str(error))
+        self.manager.close()
+        self.manager.connect()
+        self.manager.counters['reconnects'] += 1
+        self.connection = self.manager.connection
+        self.cursor = self.connection.cursor()
+        self.reconnected = True
+
+    def execute(self, sql_statement, sql_kwargs=None, cursor=None,
+                retry: bool = True):
+        """
+        execute on the request cursor, or the given one,
+        recording time and statement size
+        """
+        cursor = cursor or self.cursor
+        try:
+            with tracer.phase('sql'):
+                cursor.execute(sql_statement, sql_kwargs)
+        except (OperationalError, InterfaceError) as e:
+            if not retry or not self.can_reconnect(cursor):
+                raise
+            self.reconnect(e)
+            cursor = self.cursor
+            with tracer.phase('sql'):
+                cursor.execute(sql_statement, sql_kwargs)
+        self.started = True
+        if tracer.enabled:
+            tracer.add('statements', 1)
+            tracer.add('statement_bytes', len(cursor.query), 'Bytes')
+
+    def commit(self):
+        """
+        commit the work so far and keep the transaction going,
+        used between chunks of a chunked write
+        """
+        try:
+            self.connection.commit()
+        except Exception as e:
+            self.do_roll_back()
+            print("Error-Commit", "*"*5, str(e))
+            raise InternalServerError()
+
+    def begin_savepoint(self, name: str):
+        self.execute(
+            sql.SQL("SAVEPOINT {};").format(sql.Identifier(name)))
+        self.savepoint = name
+
+    def release_savepoint(self):
+        self.execute(
+            sql.SQL("RELEASE SAVEPOINT {};").format(
+                sql.Identifier(self.savepoint)))
+        self.savepoint = None
+
+    def rollback_savepoint(self):
+        self.execute(
+            sql.SQL("ROLLBACK TO SAVEPOINT {};").format(
+                sql.Identifier(self.savepoint)))
+
+    @staticmethod
+    def filter_field(attribute: str) -> str:
+        """
+        response field an and__/or__ filter attribute applies to
+        """
+        return attribute.split('__', 1)[1].rsplit('__', 1)[0]
+
+    def operator(self, attribute: str, resolved: bool = False) -> list:
+        """
+        generate condition based on attribute operator,
+        resolved category filters hold the matching category ids
         """
         opr = '__'+attribute.split('__')[-1]
+        table, column = COLUMNS[self.filter_field(attribute)]
+        if resolved and table == 'categories':
+            opr = '__in'
+            table, column = COLUMNS['category_id']
         sql_comparison_operator = self.comparison_operators[opr]
-        if 'tier__' in attribute:
-            field = attribute.replace(
-                "and__", "").replace(
-                "or__", "").replace(
-                "tier__", "").replace(
-                opr, "")
-            alias = 'related'
-        else:
-            field = attribute.replace(
-                "and__", "").replace(
-                "or__", "").replace(
-                opr, "")
-            alias = 'product'
+        placeholder = sql.Placeholder(attribute)
+        if opr in ('__in', '__nin'):
+            placeholder = sql.Composed(
+                [sql.SQL('('), placeholder, sql.SQL(')')])
+        elif opr == '__search':
+            column = 'search_vector'
+            placeholder = self.tsquery(attribute)
         condition = sql.Composed([
-            sql.Identifier(alias),
+            sql.Identifier(table),
             sql.SQL('.'),
-            sql.Identifier(field),
+            sql.Identifier(column),
             sql.SQL(sql_comparison_operator),
-            sql.Placeholder(attribute)
+            placeholder
         ])
         return condition
 
+    @staticmethod
+    def tsquery(attribute: str) -> sql.Composed:
+        return sql.Composed([
+            sql.SQL("websearch_to_tsquery("),
+            sql.Literal(SEARCH_CONFIG),
+            sql.SQL(", "),
+            sql.Placeholder(attribute),
+            sql.SQL(")"),
+        ])
+
+    def order_expression(self, query_params: dict) -> sql.Composed:
+        """
+        column to order by, or the text search rank of the first
+        search filter for orderby=rank
+        """
+        if query_params['orderby'] != 'rank':
+            return sql.SQL("{}.{}").format(
+                sql.Identifier('products'),
+                sql.Identifier(query_params['orderby']))
+        attribute = min(
+            k for k, v in query_params.items()
+            if v and k.startswith(('and__', 'or__'))
+            and k.endswith('__search')
+        )
+        table, _ = COLUMNS[self.filter_field(attribute)]
+        return sql.Composed([
+            sql.SQL("ts_rank("),
+            sql.Identifier(table),
+            sql.SQL("."),
+            sql.Identifier('search_vector'),
+            sql.SQL(", "),
+            self.tsquery(attribute),
+            sql.SQL(")"),
+        ])
+
     def filter_query(self, query_params: dict) -> list:
         """
         to fill and/or filters 
         """
+        resolved = bool(query_params.get('resolved_categories'))
+        # a resolved filter matching no category still rules out every row
+        kept = query_params.get('resolved_filters', ())
         for k, v in query_params.items():
-            if v:
+            if v or k in kept:
                 if k.startswith('and__'):
-                    condition = self.operator(k)
+                    condition = self.operator(k, resolved)
                     self.and_filters.append(condition)
                 elif k.startswith('or__'):
-                    condition = self.operator(k)
+                    condition = self.operator(k, resolved)
                     self.or_filters.append(condition)
 
+    def combine_filters(self, query_params: dict):
+        """
+        join and/or conditions into self.filters
+        """
+        self.and_filters = list()
+        self.or_filters = list()
+        self.filters = list()
+        self.filter_query(query_params)
+        if self.and_filters and self.or_filters:
+            self.and_filters = sql.SQL(' AND ').join(self.and_filters)
+            self.or_filters = sql.SQL(' OR ').join(self.or_filters)
+            self.filters = sql.SQL(' OR ').join(
+                [self.and_filters, self.or_filters])
+        elif self.and_filters:
+            self.filters = sql.SQL(' AND ').join(self.and_filters)
+        elif self.or_filters:
+            self.filters = sql.SQL(' OR ').join(self.or_filters)
+
+    def table_versions(self) -> tuple:
+        """
+        change counters of catalog tables, bumped by every write;
+        table_versions(table_name TEXT PRIMARY KEY, version BIGINT)
+        """
+        sql_statement = sql.SQL(
+            """
+            SELECT {table_name}, {version}
+            FROM {table_versions}
+            WHERE {table_name} IN %(tables)s;
+            """
+        ).format(
+            table_name=sql.Identifier('table_name'),
+            version=sql.Identifier('version'),
+            table_versions=sql.Identifier('table_versions'),
+        )
+        self.execute(
+            sql_statement, {'tables': ('products', 'categories')})
+        self.versions = tuple(sorted(self.cursor.fetchall()))
+        return self.versions
+
+    def bump_table_versions(self, tables: list):
+        """
+        invalidate cached reads of the written tables,
+        runs inside the write transaction
+        """
+        sql_statement = sql.SQL(
+            """
+            UPDATE {table_versions}
+            SET {version} = {version} + 1
+            WHERE {table_name} IN %(tables)s;
+            """
+        ).format(
+            table_name=sql.Identifier('table_name'),
+            version=sql.Identifier('version'),
+            table_versions=sql.Identifier('table_versions'),
+        )
+        self.execute(sql_statement, {'tables': tuple(tables)})
+        self.dirty = True
+
     def check_category_id_exists(self, products: list):
         """
         to check entered category ids in request body exists
         """
         category_ids = [product['category_id'] for product in products]
+        categories = self.category_map()
+        if categories is not None:
+            diff = set(category_ids) - set(categories)
+            if diff:
+                print("Error-Check Category ID Exists", "*"*5, diff)
+                raise NotFoundError()
+            return
         sql_statement = sql.SQL(
             """
             SELECT {_id}
@@ -133,56 +832,231 @@ class RDB:
         sql_kwargs = {
             "category_ids": tuple(category_ids),
         }
-        self.cursor.execute(sql_statement, sql_kwargs)
+        self.execute(sql_statement, sql_kwargs)
         result = self.cursor.fetchall()
-        retrieved_group_ids = [dict(record)['id'] for record in result]
+        retrieved_group_ids = [record[0] for record in result]
         diff = set(category_ids)-set(retrieved_group_ids)
         if diff:
             print("Error-Check Category ID Exists", "*"*5, diff)
             raise NotFoundError()
 
-    def select(self, query_params: dict):
+    def category_map(self):
         """
-        select query
+        cached categories, None inside a transaction that has written,
+        its versions are not committed yet
         """
-        self.filter_query(query_params)
-        query = sql.SQL("""
-        SELECT 
-            {products}.{_id},
-            {products}.{name},
-            {products}.{category_id},
-            {products}.{price},
-            {categories}.{name} AS {category_name},
-            {categories}.{description}
-        FROM {products}
-        LEFT JOIN {categories}
-        ON 
-        {products}.{category_id} = {categories}.{_id}""")
+        if self.dirty:
+            return None
+        versions = self.versions or self.table_versions()
+        return category_cache.get(self, dict(versions).get('categories'))
 
-        if self.and_filters and self.or_filters:
-            self.and_filters = sql.SQL(' AND ').join(self.and_filters)
-            self.or_filters = sql.SQL(' OR ').join(self.or_filters)
-            self.filters = sql.SQL(' OR ').join(
-                [self.and_filters, self.or_filters])
-        elif self.and_filters:
-            self.filters = sql.SQL(' AND ').join(self.and_filters)
-        elif self.or_filters:
-            self.filters = sql.SQL(' OR ').join(self.or_filters)
+    def resolve_categories(self, query_params: dict) -> dict:
+        """
+        replace category filters by the ids of the categories they accept,
+        the select then reads products only and enrich fills the
+        category columns from the cache
+        """
+        filters = [
+            k for k, v in query_params.items()
+            if v and k.startswith(('and__', 'or__'))
+            and COLUMNS[self.filter_field(k)][0] == 'categories'
+        ]
+        if any(k.rsplit('__', 1)[1] not in CATEGORY_CACHE_OPERATORS
+               for k in filters):
+            return query_params
+        if not filters and all(
+                COLUMNS[field][0] == 'products'
+                for field in self.projection(query_params)):
+            # no join to skip
+            return query_params
+        if self.category_map() is None:
+            return query_params
+        resolved = dict(
+            query_params,
+            resolved_categories=True,
+            resolved_filters=tuple(filters))
+        for k in filters:
+            resolved[k] = category_cache.match(
+                self.filter_field(k), k.rsplit('__', 1)[1], query_params[k])
+        return resolved
 
-        if self.filters:
-            query = sql.Composed([query, sql.SQL(" WHERE {filters}")])
+    def enrich(self, query_params: dict, columns: tuple, rows: list):
+        """
+        product rows with their category columns filled from the cache
+        """
+        fields = self.projection(query_params)
+        if fields == columns:
+            # only filtered by category, no category column to fill
+            return columns, rows
+        category_index = columns.index('category_id')
+        sources = [
+            (False, columns.index(field))
+            if COLUMNS[field][0] == 'products'
+            else (True, CategoryCache.COLUMNS.index(COLUMNS[field][1]))
+            for field in fields
+        ]
+        categories = category_cache.categories
+        empty = (None,) * len(CategoryCache.COLUMNS)
+        enriched = list()
+        for row in rows:
+            category = categories.get(row[category_index], empty)
+            enriched.append(tuple(
+                category[i] if from_category else row[i]
+                for from_category, i in sources))
+        return fields, enriched
+
+    def select_shape(self, query_params: dict) -> tuple:
+        """
+        everything that changes the select sql text, but not its parameters
+        """
+        kept = query_params.get('resolved_filters', ())
+        filters = tuple(sorted(
+            k for k, v in query_params.items()
+            if (v or k in kept) and k.startswith(('and__', 'or__'))
+        ))
+        return (
+            'select',
+            filters,
+            query_params['orderby'],
+            query_params['asc'],
+            query_params['pagination'],
+            'cursor_id' in query_params,
+            'cursor_id' in query_params and
+            query_params['cursor_value'] is None,
+            self.exact_count(query_params),
+            self.projection(query_params),
+            'resolved_categories' in query_params,
+        )
 
-        query = sql.Composed([query, sql.SQL(" GROUP BY {products}.{_id}")])
+    @staticmethod
+    def projection(query_params: dict) -> tuple:
+        """
+        requested fields, keyset pages always carry id and orderby
+        because the next cursor is built from them
+        """
+        fields = query_params.get('fields') or tuple(COLUMNS)
+        if query_params['pagination'] == 'cursor':
+            for field in ('id', query_params['orderby']):
+                if field not in fields:
+                    fields = fields + (field,)
+        return fields
 
+    def select_projection(self, query_params: dict) -> tuple:
+        """
+        selected fields, resolved selects read category columns from
+        the cache so they only carry the category_id to look them up by
+        """
+        fields = self.projection(query_params)
+        if not query_params.get('resolved_categories'):
+            return fields
+        selected = tuple(
+            field for field in fields if COLUMNS[field][0] == 'products')
+        if len(selected) < len(fields) and 'category_id' not in selected:
+            selected = selected + ('category_id',)
+        return selected
+
+    def needs_categories(self, query_params: dict, fields: tuple) -> bool:
+        """
+        categories are joined only for a requested or filtered column
+        """
+        if query_params.get('resolved_categories'):
+            return False
+        fields = set(fields)
+        fields.update(
+            self.filter_field(k) for k, v in query_params.items()
+            if v and k.startswith(('and__', 'or__'))
+        )
+        return any(COLUMNS[field][0] == 'categories' for field in fields)
+
+    @staticmethod
+    def exact_count(query_params: dict) -> bool:
+        """
+        exact totals ride along as a window column, keyset pages after
+        the first one only see the rows behind the cursor so they skip it
+        """
+        return query_params.get('count') == 'exact' and \
+            'cursor_id' not in query_params
+
+    @staticmethod
+    def seek(query_params: dict) -> str:
+        """
+        rows after the (orderby, id) pair a keyset page ended on,
+        NULLs of nullable columns come last ascending and first
+        descending, the postgres defaults a btree scan returns them in
+        """
+        after = '>' if query_params['asc'] else '<'
+        column = "{products}.{orderby}"
+        pair = (
+            "(" + column + ", {products}.{_id}) " + after +
+            " (%(cursor_value)s, %(cursor_id)s)"
+        )
+        if query_params['orderby'] not in NULLABLE_COLUMNS:
+            return pair
+        if query_params['cursor_value'] is None:
+            nulls = (
+                "(" + column + " IS NULL AND {products}.{_id} " + after +
+                " %(cursor_id)s)"
+            )
+            if query_params['asc']:
+                return nulls
+            return "(" + nulls + " OR " + column + " IS NOT NULL)"
         if query_params['asc']:
+            return "(" + pair + " OR " + column + " IS NULL)"
+        return pair
+
+    def build_select(self, query_params: dict) -> sql.Composed:
+        """
+        compose select sql
+        """
+        self.combine_filters(query_params)
+        columns = [
+            sql.SQL("{}.{} AS {}").format(
+                sql.Identifier(COLUMNS[field][0]),
+                sql.Identifier(COLUMNS[field][1]),
+                sql.Identifier(field))
+            for field in self.select_projection(query_params)
+        ]
+        if self.exact_count(query_params):
+            columns.append(sql.SQL("COUNT(*) OVER () AS {total_count}"))
+        query = sql.Composed([
+            sql.SQL("SELECT "),
+            sql.SQL(", ").join(columns),
+            sql.SQL(" FROM {products}"),
+        ])
+        if self.needs_categories(
+                query_params, self.select_projection(query_params)):
+            query = sql.Composed([query, sql.SQL(
+                " LEFT JOIN {categories}"
+                " ON {products}.{category_id} = {categories}.{_id}")])
+
+        # keyset pagination seeks past the last (orderby, id) pair
+        keyset = query_params['pagination'] == 'cursor'
+        seek = ""
+        if keyset and 'cursor_id' in query_params:
+            seek = self.seek(query_params)
+
+        if self.filters and seek:
             query = sql.Composed(
-                [query, sql.SQL(" ORDER BY {products}.{orderby} ASC")])
+                [query, sql.SQL(" WHERE ({filters}) AND " + seek)])
+        elif self.filters:
+            query = sql.Composed([query, sql.SQL(" WHERE {filters}")])
+        elif seek:
+            query = sql.Composed([query, sql.SQL(" WHERE " + seek)])
+
+        direction = 'ASC' if query_params['asc'] else 'DESC'
+        if keyset:
+            query = sql.Composed(
+                [query, sql.SQL(
+                    " ORDER BY {products}.{orderby} " + direction +
+                    ", {products}.{_id} " + direction)])
+            query = sql.Composed(
+                [query, sql.SQL(" LIMIT %(limit)s;")])
         else:
             query = sql.Composed(
-                [query, sql.SQL(" ORDER BY {products}.{orderby} DESC")])
-
-        query = sql.Composed(
-            [query, sql.SQL(" LIMIT %(limit)s OFFSET %(offset)s;")])
+                [query, sql.SQL(
+                    " ORDER BY {order_expression} " + direction)])
+            query = sql.Composed(
+                [query, sql.SQL(" LIMIT %(limit)s OFFSET %(offset)s;")])
 
         sql_statement = sql.SQL(
             query.as_string(self.cursor)
@@ -195,221 +1069,797 @@ class RDB:
             description=sql.Identifier('description'),
             category_id=sql.Identifier('category_id'),
             category_name=sql.Identifier('category_name'),
+            total_count=sql.Identifier('total_count'),
             orderby=sql.Identifier(query_params['orderby']),
+            order_expression=self.order_expression(query_params),
             filters=self.filters
         )
+        return sql_statement
+
+    def compile(self, shape: tuple, build, query_params: dict):
+        """
+        compiled statement of a query shape, built on first use
+        """
+        statement = statement_cache.get(shape)
+        if statement is None:
+            text = build(query_params).as_string(self.cursor)
+            statement = CompiledStatement(shape, text)
+            statement_cache[shape] = statement
+            while len(statement_cache) > STATEMENT_CACHE_SIZE:
+                statement_cache.popitem(last=False)
+        else:
+            statement_cache.move_to_end(shape)
+        return statement
+
+    def execute_compiled(self, statement: CompiledStatement,
+                         query_params: dict, cursor=None):
+        """
+        run a compiled statement, prepared once per connection
+        """
+        params = statement.bind(query_params)
+        if not USE_PREPARED_STATEMENTS:
+            self.execute(statement.text, params, cursor)
+            return
+        if statement.name not in self.manager.prepared:
+            self.execute(
+                "PREPARE " + statement.name + " AS " +
+                statement.prepare_text)
+            self.manager.prepared.add(statement.name)
+        try:
+            # not retried alone, a new connection has to prepare it again
+            if statement.param_names:
+                self.execute(
+                    "EXECUTE " + statement.name + " (" +
+                    ", ".join(['%s'] * len(statement.param_names)) + ");",
+                    [params[name] for name in statement.param_names],
+                    cursor, retry=False)
+            else:
+                self.execute(
+                    "EXECUTE " + statement.name + ";", None, cursor,
+                    retry=False)
+        except (OperationalError, InterfaceError) as e:
+            if not self.can_reconnect(cursor or self.cursor):
+                raise
+            self.reconnect(e)
+            self.execute_compiled(statement, query_params)
+
+    def fetch_rows(self, statement: CompiledStatement) -> tuple:
+        """
+        column names and tuple rows of an executed statement,
+        the column tuple is read once and shared by every row
+        """
+        if statement.columns is None:
+            statement.columns = tuple(
+                column.name for column in self.cursor.description)
+        return statement.columns, self.cursor.fetchall()
+
+    def set_statement_timeout(self):
+        """
+        cancel statements the lambda would not live to answer,
+        they would keep using the database after it timed out
+        """
+        if self.time_left is None:
+            return
+        timeout = max(
+            int(self.time_left()) - STATEMENT_TIMEOUT_RESERVE_MS,
+            MIN_STATEMENT_TIMEOUT_MS)
+        self.execute("SET LOCAL statement_timeout = %s;", (timeout,))
+
+    def reset_statement_timeout(self):
+        """
+        the timeout would last until the transaction ends, later
+        statements of a batch get their own or none
+        """
+        if self.time_left is None:
+            return
+        self.execute("RESET statement_timeout;")
+
+    def query_cost(self, statement: CompiledStatement,
+                   query_params: dict) -> float:
+        """
+        planner total cost, explained once per statement
+        and order of magnitude of the limit and the offset
+        """
+        key = (
+            statement.name,
+            (query_params.get('limit') or 0).bit_length(),
+            (query_params.get('offset') or 0).bit_length(),
+        )
+        cost = cost_cache.get(key)
+        if cost is None:
+            self.execute(
+                "EXPLAIN (FORMAT JSON) " + statement.text,
+                statement.bind(query_params))
+            cost = float(self.cursor.fetchone()[0][0]['Plan']['Total Cost'])
+            cost_cache[key] = cost
+            while len(cost_cache) > STATEMENT_CACHE_SIZE:
+                cost_cache.popitem(last=False)
+        else:
+            cost_cache.move_to_end(key)
+        return cost
+
+    def guard(self, statement: CompiledStatement, query_params: dict):
+        """
+        statement and query params within the cost budget, an exact
+        count is downgraded to an estimate first, otherwise the query
+        is rejected
+        """
+        if not QUERY_COST_BUDGET or \
+                self.query_cost(statement, query_params) <= QUERY_COST_BUDGET:
+            return statement, query_params
+        if self.exact_count(query_params):
+            query_params = dict(query_params, count='estimate')
+            statement = self.compile(
+                self.select_shape(query_params),
+                self.build_select,
+                query_params)
+            if self.query_cost(statement, query_params) <= QUERY_COST_BUDGET:
+                print("Query Downgraded", "*"*5, "exact count to estimate")
+                self.count_downgraded = True
+                return statement, query_params
+        print("Error-Query Cost", "*"*5, statement.text)
+        raise BadRequestError(
+            error_message="Query is too expensive, narrow the filters, "
+                          "lower the offset or use cursor pagination!")
+
+    @traced('select')
+    def select(self, query_params: dict) -> tuple:
+        """
+        select query, returns the column names and tuple rows
+        """
+        self.count_downgraded = False
         try:
-            self.cursor.execute(sql_statement, query_params)
-            result = [dict(record) for record in self.cursor.fetchall()]
-            return result
+            query_params = self.resolve_categories(query_params)
+            statement = self.compile(
+                self.select_shape(query_params),
+                self.build_select,
+                query_params)
+            statement, query_params = self.guard(statement, query_params)
+            self.set_statement_timeout()
+            self.execute_compiled(statement, query_params)
+            columns, rows = self.fetch_rows(statement)
+            self.reset_statement_timeout()
+            tracer.add('rows', len(rows))
+            if self.exact_count(query_params):
+                # the window count is the last projected column
+                self.total_count = rows[-1][-1] if rows else None
+                if not rows and not query_params.get('offset'):
+                    self.total_count = 0
+                columns = columns[:-1]
+                rows = [row[:-1] for row in rows]
+            if query_params.get('resolved_categories'):
+                columns, rows = self.enrich(query_params, columns, rows)
+            return columns, rows
+        except BadRequestError:
+            raise
+        except QueryCanceled as e:
+            self.do_roll_back()
+            print("Error-Select Timeout", "*"*5, str(e))
+            raise BadRequestError(
+                error_message="Query took too long, narrow the filters!")
         except Exception as e:
             self.do_roll_back()
             print("Error-Select", "*"*5, str(e))
             raise InternalServerError()
 
-    def insert(self, body: dict):
+    def aggregate_shape(self, query_params: dict) -> tuple:
+        filters = tuple(sorted(
+            k for k, v in query_params.items()
+            if v and k.startswith(('and__', 'or__'))
+        ))
+        return (
+            'aggregate',
+            filters,
+            query_params.get('group_by', ()),
+            query_params['aggregates'],
+        )
+
+    def build_aggregate(self, query_params: dict) -> sql.Composed:
         """
-        insert query
+        compose aggregate sql, grouped statistics over price
+        """
+        self.combine_filters(query_params)
+        group_by = query_params.get('group_by', ())
+        groups = [
+            sql.SQL("{}.{}").format(
+                sql.Identifier(COLUMNS[field][0]),
+                sql.Identifier(COLUMNS[field][1]))
+            for field in group_by
+        ]
+        columns = [
+            sql.SQL("{} AS {}").format(group, sql.Identifier(field))
+            for group, field in zip(groups, group_by)
+        ]
+        for function in query_params['aggregates']:
+            if function == 'count':
+                columns.append(sql.SQL("COUNT(*) AS {}").format(
+                    sql.Identifier('count')))
+            else:
+                columns.append(sql.SQL(
+                    function.upper() + "({}.{}) AS {}").format(
+                    sql.Identifier('products'),
+                    sql.Identifier('price'),
+                    sql.Identifier('price_' + function)))
+        query = sql.Composed([
+            sql.SQL("SELECT "),
+            sql.SQL(", ").join(columns),
+            sql.SQL(" FROM {products}"),
+        ])
+        if self.needs_categories(query_params, group_by):
+            query = sql.Composed([query, sql.SQL(
+                " LEFT JOIN {categories}"
+                " ON {products}.{category_id} = {categories}.{_id}")])
+        if self.filters:
+            query = sql.Composed([query, sql.SQL(" WHERE {filters}")])
+        if groups:
+            query = sql.Composed([
+                query,
+                sql.SQL(" GROUP BY "), sql.SQL(", ").join(groups),
+                sql.SQL(" ORDER BY "), sql.SQL(", ").join(groups),
+            ])
+        query = sql.Composed([query, sql.SQL(";")])
+
+        sql_statement = sql.SQL(
+            query.as_string(self.cursor)
+        ).format(
+            _id=sql.Identifier('id'),
+            products=sql.Identifier('products'),
+            categories=sql.Identifier('categories'),
+            category_id=sql.Identifier('category_id'),
+            filters=self.filters
+        )
+        return sql_statement
+
+    @traced('aggregate')
+    def aggregate(self, query_params: dict) -> list:
+        """
+        aggregate query, computed by postgres in a single statement
+        """
+        try:
+            statement = self.compile(
+                self.aggregate_shape(query_params),
+                self.build_aggregate,
+                query_params)
+            self.set_statement_timeout()
+            self.execute_compiled(statement, query_params)
+            columns, rows = self.fetch_rows(statement)
+            self.reset_statement_timeout()
+            tracer.add('rows', len(rows))
+            return records(columns, rows)
+        except QueryCanceled as e:
+            self.do_roll_back()
+            print("Error-Aggregate Timeout", "*"*5, str(e))
+            raise BadRequestError(
+                error_message="Query took too long, narrow the filters!")
+        except Exception as e:
+            self.do_roll_back()
+            print("Error-Aggregate", "*"*5, str(e))
+            raise InternalServerError()
+
+    @traced('estimate_count')
+    def estimate_count(self, query_params: dict) -> int:
+        """
+        planner row estimate of the whole filtered set, no rows are read
+        """
+        query_params = {
+            k: v for k, v in query_params.items()
+            if k not in ('count', 'cursor_value', 'cursor_id')
+        }
+        query_params.update(limit=None, offset=0)
+        try:
+            statement = self.compile(
+                self.select_shape(query_params),
+                self.build_select,
+                query_params)
+            self.set_statement_timeout()
+            self.execute(
+                "EXPLAIN (FORMAT JSON) " + statement.text,
+                statement.bind(query_params))
+            plan = self.cursor.fetchone()[0]
+            self.reset_statement_timeout()
+            return int(plan[0]['Plan']['Plan Rows'])
+        except QueryCanceled as e:
+            self.do_roll_back()
+            print("Error-Estimate Count Timeout", "*"*5, str(e))
+            raise BadRequestError(
+                error_message="Query took too long, narrow the filters!")
+        except Exception as e:
+            self.do_roll_back()
+            print("Error-Estimate Count", "*"*5, str(e))
+            raise InternalServerError()
+
+    @traced('export')
+    def export(self, query_params: dict) -> dict:
+        """
+        stream the whole filtered set as ndjson through a server-side
+        cursor, the limit is replaced by a byte budget and a continuation
+        cursor is returned when the budget runs out
+        """
+        query_params = dict(query_params, limit=None)
+        # a total does not belong on every line
+        query_params.pop('count', None)
+        orderby = query_params['orderby']
+        # bounded by the byte budget
+        lines = list()
+        size = 0
+        last = None
+        next_cursor = None
+        try:
+            statement = self.compile(
+                self.select_shape(query_params),
+                self.build_select,
+                query_params)
+            self.set_statement_timeout()
+            params = statement.bind(query_params)
+            cursor = self.connection.cursor(name='export')
+            try:
+                # not retried alone, the named cursor dies with its connection
+                self.execute(statement.text, params, cursor, retry=False)
+            except (OperationalError, InterfaceError) as e:
+                if not self.can_reconnect(self.cursor):
+                    raise
+                self.reconnect(e)
+                cursor = self.connection.cursor(name='export')
+                self.execute(statement.text, params, cursor, retry=False)
+            with cursor:
+                cursor.itersize = EXPORT_ITERSIZE
+                columns = None
+                for row in cursor:
+                    if columns is None:
+                        # known once the first batch has been fetched
+                        columns = tuple(
+                            column.name for column in cursor.description)
+                    record = dict(zip(columns, row))
+                    line = dumps(record) + '\n'
+                    # bytes once the runtime json encodes the result
+                    # string, escapes and \uXXXX sequences included
+                    line_size = len(json.dumps(line)) - 2
+                    if size + line_size > EXPORT_MAX_BYTES and last:
+                        next_cursor = encode_cursor(
+                            orderby, last[orderby], last['id'])
+                        break
+                    lines.append(line)
+                    size += line_size
+                    last = record
+            self.reset_statement_timeout()
+            tracer.add('rows', len(lines))
+            tracer.add('export_bytes', size, 'Bytes')
+            return {
+                'result': ''.join(lines),
+                'rows': len(lines),
+                'next_cursor': next_cursor,
+            }
+        except QueryCanceled as e:
+            self.do_roll_back()
+            print("Error-Export Timeout", "*"*5, str(e))
+            raise BadRequestError(
+                error_message="Query took too long, narrow the filters!")
+        except Exception as e:
+            self.do_roll_back()
+            print("Error-Export", "*"*5, str(e))
+            raise InternalServerError()
+
+    def allocate_ids(self, table: str, count: int) -> list:
         """
+        reserve ids from the table serial sequence
+        """
+        sql_statement = sql.SQL(
+            """
+            SELECT nextval(pg_get_serial_sequence(%(table)s, 'id')) AS {_id}
+            FROM generate_series(1, %(count)s);
+            """
+        ).format(
+            _id=sql.Identifier('id'),
+        )
+        self.execute(sql_statement, {'table': table, 'count': count})
+        return [record[0] for record in self.cursor.fetchall()]
+
+    def copy_rows(self, table: str, columns: tuple, rows):
+        """
+        stream rows into a table with COPY FROM STDIN
+        """
+        from bulk import IteratorFile, iter_csv
+
+        sql_statement = sql.SQL(
+            "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv);"
+        ).format(
+            table=sql.Identifier(table),
+            columns=sql.SQL(',').join(map(sql.Identifier, columns)),
+        )
+        with tracer.phase('copy'):
+            self.cursor.copy_expert(
+                sql_statement.as_string(self.cursor),
+                IteratorFile(iter_csv(rows)))
+
+    @traced('bulk_insert')
+    def bulk_insert(self, body: dict):
+        """
+        insert query for large bodies, rows are copied in bounded chunks
+        """
+        from bulk import chunked
+
         try:
             ids_map = dict()
-            if body['categories']:
-                category_table_data = [
+            for chunk in chunked(body['categories'], BULK_CHUNK_SIZE):
+                inserted_ids = self.allocate_ids('categories', len(chunk))
+                # this dictionary links inserted id to body id
+                ids_map.update(
+                    {data['id']: ii for data, ii in zip(chunk, inserted_ids)})
+                self.copy_rows(
+                    'categories',
+                    ('id', 'name', 'description'),
                     (
-                        data['name'],
-                        data['description'],
+                        (ii, data['name'], data['description'])
+                        for data, ii in zip(chunk, inserted_ids)
                     )
-                    for data in body['categories']
-                ]
-                args_str = ','.join(
-                    self.cursor.mogrify(
-                        "(%s,%s)",
-                        data
-                    ).decode("utf-8") for data in category_table_data
                 )
-                category_table_sql_statement = sql.SQL(
-                    "INSERT INTO {categories} "
-                    "({name},{description}) "
-                    f"VALUES {args_str} "
-                    "RETURNING {_id};"
-                ).format(
-                    products=sql.Identifier("categories"),
-                    _id=sql.Identifier('id'),
-                    name=sql.Identifier('name'),
-                    category_id=sql.Identifier('description'),
-                )
-                self.cursor.execute(category_table_sql_statement)
-                res = self.cursor.fetchall()
-                inserted_ids = [rec['id'] for rec in res]
-                body_ids = [pp['id']for pp in
-                                   body['categories']]
-                # this dictionary links inserted id to body id
-                ids_map = {bi: ii for bi, ii in zip(
-                    body_ids, inserted_ids)}
-            if body['products']:
-                if ids_map:
-                    product_table_data = [
+            # body ids not inserted here have to exist already
+            existing = [
+                data for data in body['products']
+                if data['category_id'] not in ids_map
+            ]
+            if existing:
+                self.check_category_id_exists(existing)
+            for chunk in chunked(body['products'], BULK_CHUNK_SIZE):
+                self.copy_rows(
+                    'products',
+                    ('name', 'category_id', 'price'),
+                    (
                         (
                             data['name'],
-                            ids_map[data['category_id']],
+                            ids_map.get(
+                                data['category_id'], data['category_id']),
                             data['price'],
                         )
-                        for data in body['products']
-                    ]
-                else:
-                    self.check_category_id_exists(
-                        body['products']
+                        for data in chunk
                     )
-                    product_table_data = [
-                        (
-                            data['name'],
-                            data['category_id'],
-                            data['price'],
-                        )
-                        for data in body['products']
-                    ]
-                args_str = ','.join(
-                    self.cursor.mogrify(
-                        "(%s,%s::INTEGER,%s::DOUBLE PRECISION)",
-                        data
-                    ).decode("utf-8") for data in product_table_data
                 )
-                product_table_sql_statement = sql.SQL(
-                    "INSERT INTO {products} "
-                    "({name},{category_id},{price}) "
-                    f"VALUES {args_str};"
-                ).format(
-                    products=sql.Identifier('products'),
-                    name=sql.Identifier('name'),
-                    category_id=sql.Identifier('category_id'),
-                    price=sql.Identifier('price'),
-                )
-                self.cursor.execute(product_table_sql_statement)
+            self.bump_table_versions(
+                [table for table in ('products', 'categories')
+                 if body[table]])
+        except NotFoundError:
+            self.do_roll_back()
+            raise
+        except ForeignKeyViolation as e:
+            self.do_roll_back()
+            print("Error-Check Category ID Exists", "*"*5, str(e))
+            raise NotFoundError()
         except Exception as e:
             self.do_roll_back()
-            print("Error-Insert", "*"*5, str(e))
+            print("Error-Bulk Insert", "*"*5, str(e))
             raise InternalServerError()
 
-    def update(self, body: dict):
+    def build_write(self, body: dict, mode: str) -> tuple:
         """
-        update query
-        """
-        # all ids are needed, check they are exists
-        if body['products']:
-            self.check_category_id_exists(body['products'])
-            product_table_data = [
-                (
-                    data['id'],
-                    data['name'],
-                    data['category_id'],
-                    data['price'],
-                )
-                for data in body['products']
-            ]
-            args_str = ','.join(
-                self.cursor.mogrify(
-                    "(%s::INTEGER,%s,%s::INTEGER,%s::DOUBLE PRECISION)",
-                    data
-                ).decode("utf-8") for data in product_table_data
-            )
-            product_table_sql_statement = sql.SQL(
-                "WITH updated({_id},{name},{category_id},{price}) "
-                f"AS (VALUES {args_str}) "
-                "UPDATE {products} "
-                "SET "
-                "{name}=updated.{name}, "
-                "{category_id}=updated.{category_id}, "
-                "{price}=updated.{price} "
-                "FROM updated "
-                "WHERE ({products}.{_id} = updated.{_id});"
-            ).format(
-                _id=sql.Identifier('id'),
-                name=sql.Identifier('name'),
-                category_id=sql.Identifier('category_id'),
-                price=sql.Identifier('price'),
-                products=sql.Identifier('products'),
-            )
-        if body['categories']:
-            category_table_data = [
-                (
-                    data['id'],
-                    data['name'],
-                    data['description'],
-                )
-                for data in body['categories']
-            ]
-            args_str = ','.join(
-                self.cursor.mogrify(
-                    "(%s::INTEGER,%s,%s)",
-                    data
-                ).decode("utf-8") for data in category_table_data
+        compose one data-modifying statement for insert, update or upsert;
+        categories and products are written together, referenced category
+        ids missing from the table are collected by an anti-join instead
+        of a separate existence check
+        """
+        ctes = list()
+        sql_kwargs = {
+            'tables': [table for table in ('products', 'categories')
+                       if body[table]],
+        }
+        categories = body['categories']
+        products = body['products']
+        if categories:
+            sql_kwargs.update(
+                category_ids=[data['id'] for data in categories],
+                category_names=[data['name'] for data in categories],
+                category_descriptions=[
+                    data['description'] for data in categories],
             )
-            category_table_sql_statement = sql.SQL(
-                "WITH updated({_id},{name},{description}) "
-                f"AS (VALUES {args_str}) "
-                "UPDATE {categories} "
-                "SET "
-                "{name}=updated.{name}, "
-                "{description}=updated.{description} "
-                "FROM updated "
-                "WHERE ({categories}.{_id} = updated.{_id});"
-            ).format(
-                _id=sql.Identifier('id'),
-                categories=sql.Identifier("categories"),
-                name=sql.Identifier('name'),
-                description=sql.Identifier('description'),
+            ctes.append(
+                "input_categories AS ("
+                "SELECT * FROM unnest("
+                "%(category_ids)s::INTEGER[], "
+                "%(category_names)s::TEXT[], "
+                "%(category_descriptions)s::TEXT[]) "
+                "WITH ORDINALITY AS t(id, name, description, ord))")
+            if mode == 'insert':
+                # ids are drawn up front so body ids map to inserted ids
+                ctes.append(
+                    "allocated AS ("
+                    "SELECT nextval(pg_get_serial_sequence("
+                    "'categories', 'id')) AS id, id AS ref, "
+                    "name, description "
+                    "FROM input_categories ORDER BY ord)")
+                ctes.append(
+                    "written_categories AS ("
+                    "INSERT INTO {categories} (id, name, description) "
+                    "SELECT id, name, description FROM allocated "
+                    "RETURNING id)")
+            else:
+                # a repeated id is written once, with its last values
+                ctes.append(
+                    "latest_categories AS ("
+                    "SELECT DISTINCT ON (id) id, name, description "
+                    "FROM input_categories ORDER BY id, ord DESC)")
+            if mode == 'update':
+                ctes.append(
+                    "written_categories AS ("
+                    "UPDATE {categories} SET "
+                    "name = i.name, description = i.description "
+                    "FROM latest_categories i "
+                    "WHERE {categories}.id = i.id "
+                    "RETURNING {categories}.id)")
+            elif mode == 'upsert':
+                ctes.append(
+                    "written_categories AS ("
+                    "INSERT INTO {categories} (id, name, description) "
+                    "SELECT id, name, description FROM latest_categories "
+                    "ON CONFLICT (id) DO UPDATE SET "
+                    "name = EXCLUDED.name, "
+                    "description = EXCLUDED.description "
+                    "RETURNING id)")
+        if products:
+            sql_kwargs.update(
+                product_ids=[data['id'] for data in products],
+                product_names=[data['name'] for data in products],
+                product_category_ids=[
+                    data['category_id'] for data in products],
+                product_prices=[data['price'] for data in products],
             )
+            ctes.append(
+                "input_products AS ("
+                "SELECT * FROM unnest("
+                "%(product_ids)s::INTEGER[], "
+                "%(product_names)s::TEXT[], "
+                "%(product_category_ids)s::INTEGER[], "
+                "%(product_prices)s::DOUBLE PRECISION[]) "
+                "WITH ORDINALITY AS t(id, name, category_id, price, ord))")
+            if mode == 'insert' and categories:
+                # body category ids point at the categories inserted here
+                ctes.append(
+                    "resolved_products AS ("
+                    "SELECT p.id, p.name, "
+                    "COALESCE(a.id, p.category_id) AS category_id, p.price "
+                    "FROM input_products p "
+                    # a repeated body id maps to its last category, once
+                    "LEFT JOIN (SELECT DISTINCT ON (ref) ref, id "
+                    "FROM allocated ORDER BY ref, id DESC) a "
+                    "ON a.ref = p.category_id)")
+            elif mode == 'insert':
+                ctes.append(
+                    "resolved_products AS ("
+                    "SELECT id, name, category_id, price "
+                    "FROM input_products)")
+            else:
+                # a repeated id is written once, with its last values
+                ctes.append(
+                    "resolved_products AS ("
+                    "SELECT DISTINCT ON (id) id, name, category_id, price "
+                    "FROM input_products ORDER BY id, ord DESC)")
+            missing = (
+                "missing AS ("
+                "SELECT DISTINCT p.category_id FROM resolved_products p "
+                "LEFT JOIN {categories} c ON c.id = p.category_id "
+                "WHERE c.id IS NULL")
+            # categories written by this statement are not visible yet
+            if categories and mode == 'insert':
+                missing += " AND p.category_id NOT IN (SELECT id FROM allocated)"
+            elif categories and mode == 'upsert':
+                missing += (
+                    " AND p.category_id NOT IN "
+                    "(SELECT id FROM input_categories)")
+            ctes.append(missing + ")")
+            if mode == 'insert':
+                ctes.append(
+                    "written_products AS ("
+                    "INSERT INTO {products} (name, category_id, price) "
+                    "SELECT name, category_id, price FROM resolved_products "
+                    "WHERE NOT EXISTS (SELECT 1 FROM missing))")
+            elif mode == 'update':
+                ctes.append(
+                    "written_products AS ("
+                    "UPDATE {products} SET "
+                    "name = p.name, category_id = p.category_id, "
+                    "price = p.price "
+                    "FROM resolved_products p "
+                    "WHERE {products}.id = p.id "
+                    "AND NOT EXISTS (SELECT 1 FROM missing))")
+            else:
+                ctes.append(
+                    "written_products AS ("
+                    "INSERT INTO {products} (id, name, category_id, price) "
+                    "SELECT id, name, category_id, price "
+                    "FROM resolved_products "
+                    "WHERE NOT EXISTS (SELECT 1 FROM missing) "
+                    "ON CONFLICT (id) DO UPDATE SET "
+                    "name = EXCLUDED.name, "
+                    "category_id = EXCLUDED.category_id, "
+                    "price = EXCLUDED.price)")
+        ctes.append(
+            "versions AS ("
+            "UPDATE {table_versions} SET version = version + 1 "
+            "WHERE table_name = ANY(%(tables)s::TEXT[]))")
+        result = "SELECT ARRAY(SELECT category_id FROM missing) AS missing" \
+            if products else "SELECT ARRAY[]::INTEGER[] AS missing"
+        if mode == 'upsert':
+            # explicit ids must not be handed out again by the sequences,
+            # which only ever move forward, ids they already handed out
+            # may belong to deleted or not yet committed rows
+            sequences = list()
+            for table, cte in (('categories', 'input_categories'),
+                               ('products', 'input_products')):
+                if body[table]:
+                    sequence = (
+                        "pg_get_serial_sequence('" + table + "', 'id')")
+                    sequences.append(
+                        "(SELECT setval(" + sequence + ", max(i.id)) "
+                        "FROM " + cte + " i "
+                        "HAVING max(i.id) > COALESCE("
+                        "pg_sequence_last_value(" + sequence + "::REGCLASS)"
+                        ", 0))")
+            result += ", " + ", ".join(sequences)
+        sql_statement = sql.SQL(
+            "WITH " + ", ".join(ctes) + " " + result + ";"
+        ).format(
+            products=sql.Identifier('products'),
+            categories=sql.Identifier('categories'),
+            table_versions=sql.Identifier('table_versions'),
+        )
+        return sql_statement, sql_kwargs
+
+    def write(self, body: dict, mode: str):
+        """
+        run a write statement in a single round trip
+        """
+        sql_statement, sql_kwargs = self.build_write(body, mode)
         try:
-            if body['products']:
-                self.cursor.execute(product_table_sql_statement)
-            if body['categories']:
-                self.cursor.execute(category_table_sql_statement)
+            self.execute(sql_statement, sql_kwargs)
+            missing = self.cursor.fetchone()[0]
+            self.dirty = True
+        except ForeignKeyViolation as e:
+            self.do_roll_back()
+            print("Error-Check Category ID Exists", "*"*5, str(e))
+            raise NotFoundError()
         except Exception as e:
             self.do_roll_back()
-            print("Error-Update", "*"*5, str(e))
+            print("Error-" + mode.capitalize(), "*"*5, str(e))
             raise InternalServerError()
+        if missing:
+            self.do_roll_back()
+            print("Error-Check Category ID Exists", "*"*5, missing)
+            raise NotFoundError()
 
-    def delete(self, body: dict):
+    @traced('insert')
+    def insert(self, body: dict):
         """
-        delete query
+        insert query
         """
-        # all ids are needed, check they are exists
-        product_ids = [product['id'] for product in body['products']]
-        category_ids = [category['id'] for category in body['categories']]
-        # product table sql query
-        product_table_sql_statement = sql.SQL(
-            """
-            DELETE FROM {table_name} WHERE {_id} in %(ids)s;
-            """
-        ).format(
-            table_name=sql.Identifier("products"),
-            _id=sql.Identifier('id')
-        )
-        product_table_sql_kwargs = {
-            'ids': tuple(product_ids)
-        }
-        # category table sql query
-        category_table_sql_statement = sql.SQL(
+        if len(body['products']) + len(body['categories']) \
+                >= BULK_INSERT_THRESHOLD:
+            return self.bulk_insert(body)
+        self.write(body, 'insert')
+
+    @traced('update')
+    def update(self, body: dict):
+        """
+        update query, rows missing by id are created in upsert mode
+        """
+        self.write(body, 'upsert' if body.get('upsert') else 'update')
+
+    def delete_rows(self, table: str, ids: list):
+        """
+        delete by id, the ids travel as one array parameter
+        """
+        sql_statement = sql.SQL(
             """
-            DELETE FROM {table_name} WHERE {_id} in %(ids)s;
+            DELETE FROM {table_name} WHERE {_id} = ANY(%(ids)s::INTEGER[]);
             """
         ).format(
-            table_name=sql.Identifier("categories"),
+            table_name=sql.Identifier(table),
             _id=sql.Identifier('id')
         )
-        category_table_sql_kwargs = {
-            'ids': tuple(category_ids)
-        }
+        self.execute(sql_statement, {'ids': ids})
+
+    @traced('delete')
+    def delete(self, body: dict):
+        """
+        delete query
+        """
+        product_ids = [product['id'] for product in body['products']]
+        category_ids = [category['id'] for category in body['categories']]
         try:
-            if category_ids:
-                self.cursor.execute(
-                    category_table_sql_statement,
-                    category_table_sql_kwargs)
+            # products first, categories still in use are refused
             if product_ids:
-                self.cursor.execute(
-                    product_table_sql_statement,
-                    product_table_sql_kwargs)
+                self.delete_rows('products', product_ids)
+            if category_ids:
+                self.delete_rows('categories', category_ids)
+            self.bump_table_versions(
+                [table for table in ('products', 'categories')
+                 if body[table]])
+        except ForeignKeyViolation as e:
+            self.do_roll_back()
+            print("Error-Category In Use", "*"*5, str(e))
+            raise BadRequestError(error_message=CATEGORY_IN_USE)
         except Exception as e:
             self.do_roll_back()
             print("Error-Delete", "*"*5, str(e))
             raise InternalServerError()
+
+    @staticmethod
+    def needs_chunks(body: dict) -> bool:
+        return bool(body.get('continuation')) or \
+            len(body['products']) + len(body['categories']) > \
+            WRITE_CHUNK_SIZE
+
+    @traced('chunked')
+    def chunked(self, body: dict, method: str, time_left=None) -> dict:
+        """
+        run a large PUT or DELETE as chunks of WRITE_CHUNK_SIZE rows,
+        each committed on its own so statements and row locks stay small;
+        stops when time_left() runs low, or at a failed chunk once earlier
+        ones are committed, and returns a continuation, the client sends
+        the same body again with it to resume
+        """
+        # categories are written before and deleted after their products
+        tables = ('categories', 'products')
+        if method == 'DELETE':
+            tables = tables[::-1]
+        steps = [(table, body[table]) for table in tables if body[table]]
+        digest = hashlib.sha1(dumps(
+            [body['categories'], body['products'], method]
+        ).encode('utf-8')).hexdigest()[:16]
+        step, offset = 0, 0
+        if body.get('continuation'):
+            step, offset = decode_continuation(body['continuation'], digest)
+        progress = {
+            table: {'done': 0, 'total': len(rows)} for table, rows in steps
+        }
+        for table, _ in steps[:step]:
+            progress[table]['done'] = progress[table]['total']
+        if step < len(steps):
+            progress[steps[step][0]]['done'] = offset
+        chunks = 0
+        while step < len(steps):
+            if chunks and time_left is not None and \
+                    time_left() < CHUNK_TIME_RESERVE_MS:
+                return {
+                    'progress': progress,
+                    'continuation': encode_continuation(
+                        step, offset, digest),
+                }
+            table, rows = steps[step]
+            chunk = rows[offset:offset + WRITE_CHUNK_SIZE]
+            try:
+                if method == 'DELETE':
+                    try:
+                        self.delete_rows(table, [row['id'] for row in chunk])
+                        self.bump_table_versions([table])
+                    except ForeignKeyViolation as e:
+                        self.do_roll_back()
+                        print("Error-Category In Use", "*"*5, str(e))
+                        raise BadRequestError(error_message=CATEGORY_IN_USE)
+                    except Exception as e:
+                        self.do_roll_back()
+                        print("Error-Delete", "*"*5, str(e))
+                        raise InternalServerError()
+                else:
+                    other = 'products' if table == 'categories' \
+                        else 'categories'
+                    self.update({table: chunk, other: [],
+                                 'upsert': body.get('upsert')})
+                self.commit()
+            except (BadRequestError, NotFoundError, InternalServerError) as e:
+                if not chunks:
+                    raise
+                # the chunks before this one stay committed,
+                # the client resumes at the failed one
+                return {
+                    'progress': progress,
+                    'continuation': encode_continuation(
+                        step, offset, digest),
+                    'is_success': False,
+                    'error': str(e),
+                }
+            chunks += 1
+            offset += len(chunk)
+            progress[table]['done'] = offset
+            print("Chunk", "*"*5, method, table, offset, len(rows))
+            tracer.add('chunks', 1)
+            if offset >= len(rows):
+                step, offset = step + 1, 0
+        return {'progress': progress, 'continuation': None}
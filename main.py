@@ -2,31 +2,81 @@
 This module contains lambda function
 """
 
-from actions import Action
+from actions import Action, RESULT_MESSAGES
+from db import connection_router
+from serialization import dumps
+from tracing import tracer
+import os
 import sys
 
 sys.tracebacklimit = 0
 
 
+def init():
+    """
+    work every request needs, done once in the lambda init phase
+    where it does not count against the first request
+    """
+    try:
+        # fetches the secret and opens the warm connections, each bounded
+        # by DB_CONNECT_TIMEOUT; GET usually lands on a reader if any
+        connection_router.acquire().release()
+        if connection_router.readers:
+            connection_router.acquire(read_only=True).release()
+    except Exception as e:
+        # the first request reconnects on its own
+        print("Error-Init", "*"*5, str(e))
+
+
+if os.environ.get('PRELOAD', '1') == '1':
+    init()
+
+
 def lambda_handler(event, context):
     query_params = event.get('queryParams', dict())
     body = event.get('body', dict())
     method = event.get('method')
+    headers = event.get('headers', dict())
+    client_id = (event.get('authorizer_context') or dict()).get('user_id')
+
+    tracer.start(method=str(method))
+    try:
+        with tracer.phase('handler'):
+            response = handle(
+                method, query_params, body, headers, client_id, context)
+        if tracer.enabled:
+            with tracer.phase('serialize'):
+                tracer.add('response_bytes', len(dumps(response)), 'Bytes')
+        return response
+    except Exception as e:
+        tracer.set_property('error', type(e).__name__)
+        raise
+    finally:
+        tracer.emit()
+
 
+def handle(method, query_params, body, headers,
+           client_id=None, context=None) -> dict:
     response = dict()
 
     if method == 'GET':
-        result = Action.get(query_params)
-        response['result'] = result
+        response.update(Action.get(
+            query_params, headers=headers,
+            client_id=client_id, context=context))
     elif method == 'POST':
-        Action.post(body)
-        response['result'] = "Data has been inserted successfully."
+        Action.post(body, client_id=client_id)
+        response['result'] = RESULT_MESSAGES[method]
     elif method == 'PUT':
-        Action.put(body)
-        response['result'] = "Data has been updated successfully."
+        response['result'] = RESULT_MESSAGES[method]
+        response.update(Action.put(
+            body, client_id=client_id, context=context))
     elif method == 'DELETE':
-        Action.delete(body)
-        response['result'] = "Data has been removed successfully."
+        response['result'] = RESULT_MESSAGES[method]
+        response.update(Action.delete(
+            body, client_id=client_id, context=context))
+    elif method == 'BATCH':
+        response.update(Action.batch(
+            body, client_id=client_id, context=context))
 
-    response['is_success'] = True
+    response.setdefault('is_success', True)
     return response
@@ -0,0 +1,255 @@
+"""
+This module contains database schema migrations
+and a check of which GET filters are served by indexes
+
+    python schema.py migrate
+    python schema.py check
+"""
+
+import sys
+
+
+MIGRATIONS = [
+    (
+        1,
+        "catalog tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS categories (
+                id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                description VARCHAR(255) NOT NULL
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                category_id INTEGER
+                    REFERENCES categories (id) ON DELETE SET NULL,
+                price DOUBLE PRECISION NOT NULL
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            );
+            """,
+            """
+            INSERT INTO table_versions (table_name)
+            VALUES ('products'), ('categories')
+            ON CONFLICT DO NOTHING;
+            """,
+        ],
+    ),
+    (
+        2,
+        "filter and orderby indexes",
+        [
+            # orderby columns, id breaks ties for keyset pagination
+            """
+            CREATE INDEX IF NOT EXISTS products_price_id_idx
+            ON products (price, id);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS products_name_id_idx
+            ON products (name, id);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS products_category_id_id_idx
+            ON products (category_id, id);
+            """,
+            # equality and range filters on joined category columns
+            """
+            CREATE INDEX IF NOT EXISTS categories_name_idx
+            ON categories (name);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS categories_description_idx
+            ON categories (description);
+            """,
+            # __like is wrapped in %...%, only trigram indexes serve it
+            """
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS products_name_trgm_idx
+            ON products USING GIN (name gin_trgm_ops);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS categories_name_trgm_idx
+            ON categories USING GIN (name gin_trgm_ops);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS categories_description_trgm_idx
+            ON categories USING GIN (description gin_trgm_ops);
+            """,
+        ],
+    ),
+    (
+        3,
+        "full text search vectors",
+        [
+            # the config has to match db.SEARCH_CONFIG
+            """
+            ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector
+            tsvector GENERATED ALWAYS AS
+            (to_tsvector('english', name)) STORED;
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS products_search_vector_idx
+            ON products USING GIN (search_vector);
+            """,
+            """
+            ALTER TABLE categories ADD COLUMN IF NOT EXISTS search_vector
+            tsvector GENERATED ALWAYS AS
+            (to_tsvector('english', description)) STORED;
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS categories_search_vector_idx
+            ON categories USING GIN (search_vector);
+            """,
+        ],
+    ),
+    (
+        4,
+        "restrict deleting referenced categories",
+        [
+            # SET NULL left products the api cannot write or page over,
+            # deleting a category in use is now refused; rows nulled by
+            # earlier deletes are kept, so category_id stays nullable
+            """
+            ALTER TABLE products
+            DROP CONSTRAINT IF EXISTS products_category_id_fkey;
+            """,
+            """
+            ALTER TABLE products ADD CONSTRAINT products_category_id_fkey
+            FOREIGN KEY (category_id)
+            REFERENCES categories (id) ON DELETE RESTRICT;
+            """,
+        ],
+    ),
+]
+
+
+def applied_versions(cursor) -> set:
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """
+    )
+    cursor.execute("SELECT version FROM schema_migrations;")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(connection) -> list:
+    """
+    apply pending migrations, each one in its own transaction
+    """
+    applied = list()
+    with connection.cursor() as cursor:
+        done = applied_versions(cursor)
+        connection.commit()
+        for version, name, statements in MIGRATIONS:
+            if version in done:
+                continue
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) "
+                    "VALUES (%s, %s);",
+                    (version, name))
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                print("Error-Migration", "*"*5, version, name, str(e))
+                raise
+            print("Migration", "*"*5, version, name)
+            applied.append(version)
+    return applied
+
+
+def sample_filter(field: str, opr: str) -> str:
+    """
+    a representative value for one Filter field and operator
+    """
+    if field in ('id', 'category_id'):
+        value = '1'
+    elif field == 'price':
+        value = '10'
+    else:
+        value = "'a'" if opr in ('in', 'nin') else 'a'
+    if opr in ('in', 'nin'):
+        return f"({value},{value})"
+    return value
+
+
+def scanned_relations(plan: dict) -> set:
+    """
+    relations read by a sequential scan anywhere in the plan
+    """
+    relations = set()
+    if plan.get('Node Type') == 'Seq Scan':
+        relations.add(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        relations |= scanned_relations(child)
+    return relations
+
+
+def check_index_usage(orderbys=('id', 'name', 'category_id', 'price')):
+    """
+    run EXPLAIN ANALYZE on every supported filter and orderby pair and
+    report the ones that fall back to sequential scans, run it against
+    production sized data, the planner seq scans small tables anyway
+    """
+    from db import RDB
+    from validator import Filter, validate_query_params
+
+    report = list()
+    with RDB() as rdb:
+        for attribute in Filter.model_fields:
+            field, opr = attribute.rsplit('__', 1)
+            for orderby in orderbys:
+                query_params = validate_query_params({
+                    'filters': f"&{attribute}={sample_filter(field, opr)}*",
+                    'orderby': orderby,
+                })
+                statement = rdb.compile(
+                    rdb.select_shape(query_params),
+                    rdb.build_select,
+                    query_params)
+                rdb.cursor.execute(
+                    "EXPLAIN (ANALYZE, FORMAT JSON) " + statement.text,
+                    statement.bind(query_params))
+                plan = rdb.cursor.fetchone()[0][0]
+                seq_scans = scanned_relations(plan['Plan'])
+                if seq_scans:
+                    report.append({
+                        'filter': attribute,
+                        'orderby': orderby,
+                        'seq_scans': sorted(seq_scans),
+                        'execution_ms': plan.get('Execution Time'),
+                    })
+        rdb.connection.rollback()
+    return report
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command == 'migrate':
+        from db import connection_manager
+
+        migrate(connection_manager.acquire())
+        connection_manager.close()
+    elif command == 'check':
+        for row in check_index_usage():
+            print(row)
+    else:
+        print("usage: python schema.py [migrate|check]")
+        sys.exit(1)
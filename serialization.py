@@ -0,0 +1,35 @@
+"""
+This module contains json encoding of responses,
+orjson is used when the deployment layer ships it
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value) -> str:
+    """
+    compact json text, values json does not know become strings
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=str).decode('utf-8')
+    return json.dumps(value, default=str, separators=(',', ':'))
+
+
+def columnar(columns: tuple, rows: list) -> dict:
+    """
+    one list of column names plus one array per row,
+    keys are not repeated on every row
+    """
+    return {'columns': list(columns), 'rows': rows}
+
+
+def records(columns: tuple, rows: list) -> list:
+    """
+    tuple rows as dicts keyed by one shared column tuple
+    """
+    return [dict(zip(columns, row)) for row in rows]
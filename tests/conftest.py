@@ -0,0 +1,41 @@
+"""
+shared fixtures, the tests run against the postgres database
+named by TEST_DATABASE_DSN and are skipped without it
+
+    TEST_DATABASE_DSN="dbname=crud_test" python -m pytest -q
+"""
+
+import os
+import sys
+
+import pytest
+
+TEST_DATABASE_DSN = os.environ.get('TEST_DATABASE_DSN')
+
+# db reads its settings at import, main must not connect on import
+if TEST_DATABASE_DSN:
+    os.environ['DATABASE_DSN'] = TEST_DATABASE_DSN
+os.environ['PRELOAD'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def rdb():
+    """
+    empty catalog tables and caches, the open connection to seed them
+    """
+    if not TEST_DATABASE_DSN:
+        pytest.skip("TEST_DATABASE_DSN is not set")
+    from db import RDB, category_cache
+    from cache import query_cache
+    from schema import migrate
+    with RDB() as rdb:
+        migrate(rdb.connection)
+        rdb.execute(
+            "TRUNCATE products, categories RESTART IDENTITY;", dict())
+        rdb.commit()
+        category_cache.version = None
+        category_cache.categories = None
+        query_cache.clear()
+        yield rdb
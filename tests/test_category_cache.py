@@ -0,0 +1,48 @@
+"""
+category filters resolved from the in-process category cache
+"""
+
+from actions import Action
+from db import category_cache
+
+
+def ids(filters: str) -> list:
+    response = Action.get({'filters': filters, 'orderby': 'id', 'asc': True})
+    return [row['id'] for row in response['result']]
+
+
+def seed():
+    Action.post({
+        'categories': [
+            {'id': 1, 'name': 'tools', 'description': 'hand tools'},
+            {'id': 2, 'name': 'paint', 'description': 'wall paint'},
+        ],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 10},
+            {'id': 2, 'name': 'roller', 'category_id': 2, 'price': 20},
+        ],
+    })
+
+
+def test_category_filters_use_the_cache(rdb):
+    seed()
+    assert ids('&category_name__eq=paint*') == [2]
+    hits = category_cache.counters['hits']
+    assert ids('&category_name__like=too*') == [1]
+    assert category_cache.counters['hits'] == hits + 1
+
+
+def test_category_filter_without_match_is_empty(rdb):
+    seed()
+    assert ids('&category_name__eq=glue*') == []
+    assert ids("&category_name__nin=('glue',)*") == [1, 2]
+
+
+def test_category_cache_reloads_after_a_write(rdb):
+    seed()
+    assert ids('&category_name__eq=paint*') == [2]
+    loads = category_cache.counters['loads']
+    Action.put({'categories': [
+        {'id': 1, 'name': 'paint', 'description': 'hand tools'}]})
+    assert ids('&category_name__eq=paint*') == [1, 2]
+    assert category_cache.counters['loads'] == loads + 1
@@ -0,0 +1,49 @@
+"""
+PUT and DELETE bodies written in committed chunks
+"""
+
+import pytest
+
+from actions import Action
+from exceptions import NotFoundError
+
+TOOLS = {'id': 1, 'name': 'tools', 'description': 'hand tools'}
+PAINT = {'id': 9, 'name': 'paint', 'description': 'wall paint'}
+PRODUCTS = [
+    {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 12},
+    {'id': 2, 'name': 'roller', 'category_id': 9, 'price': 22},
+    {'id': 3, 'name': 'saw', 'category_id': 1, 'price': 32},
+]
+
+
+@pytest.fixture
+def chunks(rdb, monkeypatch):
+    monkeypatch.setattr('db.WRITE_CHUNK_SIZE', 1)
+    Action.post({'categories': [TOOLS], 'products': [
+        dict(product, category_id=1, price=1) for product in PRODUCTS]})
+
+
+def prices() -> list:
+    response = Action.get({'orderby': 'id', 'asc': True})
+    return [row['price'] for row in response['result']]
+
+
+def test_failed_chunk_returns_progress_and_continuation(chunks):
+    response = Action.put({'products': PRODUCTS})
+    assert response['is_success'] is False
+    assert 'Not Found' in response['error']
+    assert response['progress'] == {'products': {'done': 1, 'total': 3}}
+    assert prices() == [12, 1, 1]
+    # the missing category is created, the same body resumes at chunk two
+    Action.put({'upsert': True, 'categories': [PAINT]})
+    response = Action.put({
+        'products': PRODUCTS, 'continuation': response['continuation']})
+    assert response['continuation'] is None
+    assert response['progress'] == {'products': {'done': 3, 'total': 3}}
+    assert prices() == [12, 22, 32]
+
+
+def test_failed_first_chunk_raises(chunks):
+    with pytest.raises(NotFoundError):
+        Action.put({'products': PRODUCTS[1:]})
+    assert prices() == [1, 1, 1]
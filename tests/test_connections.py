@@ -0,0 +1,37 @@
+"""
+reader routing and read-your-writes pins, no database needed
+"""
+
+import time
+
+from db import ConnectionManager, ConnectionRouter
+
+
+def test_pins_expire_and_are_pruned(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    router = ConnectionRouter(ConnectionManager(), [], pin_window=5)
+    router.pin('a')
+    now[0] += 3
+    router.pin('b')
+    assert router.is_pinned('a') and router.is_pinned('b')
+    now[0] += 3
+    assert not router.is_pinned('a')
+    router.pin('c')
+    now[0] += 3
+    # b expired while nobody asked for it, the next pin drops it
+    router.pin('a')
+    assert list(router.pinned) == ['c', 'a']
+
+
+def test_repinned_client_keeps_the_later_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    router = ConnectionRouter(ConnectionManager(), [], pin_window=5)
+    router.pin('a')
+    router.pin('b')
+    now[0] += 3
+    router.pin('a')
+    now[0] += 3
+    router.pin('c')
+    assert list(router.pinned) == ['a', 'c']
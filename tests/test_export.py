@@ -0,0 +1,41 @@
+"""
+ndjson export through GET
+"""
+
+import json
+
+from psycopg2 import connect
+
+from actions import Action
+from conftest import TEST_DATABASE_DSN
+
+
+def seed():
+    Action.post({
+        'categories': [
+            {'id': 1, 'name': 'tools', 'description': 'hand tools'},
+        ],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 10},
+            {'id': 2, 'name': 'saw', 'category_id': 1, 'price': 20},
+        ],
+    })
+
+
+def test_export_lines_have_no_total(rdb):
+    seed()
+    response = Action.get({'format': 'ndjson', 'count': 'exact'})
+    records = [json.loads(line) for line in response['result'].splitlines()]
+    assert [record['id'] for record in records] == [2, 1]
+    assert all('total_count' not in record for record in records)
+
+
+def test_export_reconnects_after_lost_connection(rdb):
+    seed()
+    rdb.commit()
+    pid = rdb.connection.get_backend_pid()
+    with connect(TEST_DATABASE_DSN) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s);", (pid,))
+    response = Action.get({'format': 'ndjson'})
+    assert response['rows'] == 2
@@ -0,0 +1,84 @@
+"""
+keyset pagination through GET
+"""
+
+import json
+
+from actions import Action
+
+
+def pages(**query_params) -> list:
+    """
+    ids of every page, following next_cursor to the end
+    """
+    ids = list()
+    cursor = None
+    while True:
+        params = dict(query_params, pagination='cursor')
+        if cursor:
+            params['cursor'] = cursor
+        response = Action.get(params)
+        ids.append([row['id'] for row in response['result']])
+        cursor = response.get('next_cursor')
+        if not cursor:
+            return ids
+
+
+def seed(rdb):
+    """
+    two categories, five products of which two have no category
+    """
+    Action.post({
+        'categories': [
+            {'id': 1, 'name': 'tools', 'description': 'hand tools'},
+            {'id': 2, 'name': 'paint', 'description': 'wall paint'},
+        ],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 10},
+            {'id': 2, 'name': 'saw', 'category_id': 2, 'price': 20},
+            {'id': 3, 'name': 'brush', 'category_id': 1, 'price': 30},
+        ],
+    })
+    # left behind by the foreign key before it refused category deletes
+    rdb.execute(
+        "INSERT INTO products (id, name, category_id, price) "
+        "VALUES (4, 'tape', NULL, 5), (5, 'glue', NULL, 7);", dict())
+    rdb.commit()
+
+
+def test_keyset_pages_every_row_once(rdb):
+    seed(rdb)
+    ids = pages(orderby='price', asc=True, limit=2)
+    assert ids == [[4, 5], [1, 2], [3]]
+
+
+def test_keyset_pages_past_null_values_ascending(rdb):
+    seed(rdb)
+    ids = pages(orderby='category_id', asc=True, limit=2)
+    assert ids == [[1, 3], [2, 4], [5]]
+
+
+def test_keyset_pages_past_null_values_descending(rdb):
+    seed(rdb)
+    ids = pages(orderby='category_id', asc=False, limit=2)
+    assert ids == [[5, 4], [2, 3], [1]]
+
+
+def test_export_resumes_past_null_values(rdb, monkeypatch):
+    seed(rdb)
+    # one row per response
+    monkeypatch.setattr('db.EXPORT_MAX_BYTES', 1)
+    ids = list()
+    cursor = None
+    while True:
+        params = {'format': 'ndjson', 'orderby': 'category_id', 'asc': True}
+        if cursor:
+            params['cursor'] = cursor
+        response = Action.get(params)
+        ids.extend(
+            json.loads(line)['id']
+            for line in response['result'].splitlines())
+        cursor = response['next_cursor']
+        if not cursor:
+            break
+    assert ids == [1, 3, 2, 4, 5]
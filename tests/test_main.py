@@ -0,0 +1,23 @@
+"""
+lambda init phase, no database needed
+"""
+
+import main
+from db import connection_router
+
+
+def test_init_skips_reader_warm_up_without_readers(monkeypatch):
+    acquired = list()
+
+    class Manager:
+        def release(self):
+            pass
+
+    def acquire(read_only=False, client_id=None):
+        acquired.append(read_only)
+        return Manager()
+
+    monkeypatch.setattr(connection_router, 'readers', [])
+    monkeypatch.setattr(connection_router, 'acquire', acquire)
+    main.init()
+    assert acquired == [False]
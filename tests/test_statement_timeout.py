@@ -0,0 +1,40 @@
+"""
+statement timeouts bounded by the remaining lambda time
+"""
+
+import pytest
+
+from actions import Action
+from validator import validate_query_params
+
+
+def statement_timeout(rdb) -> str:
+    rdb.execute("SHOW statement_timeout;")
+    return rdb.cursor.fetchone()[0]
+
+
+@pytest.mark.parametrize('query_params', [
+    {'count': 'exact'},
+    {'aggregates': 'count'},
+    {'format': 'ndjson'},
+])
+def test_timeout_ends_with_its_statement(rdb, query_params):
+    rdb.time_left = lambda: 2000
+    Action.get(query_params, rdb=rdb)
+    # later statements of the same batch run without it
+    assert statement_timeout(rdb) == '0'
+
+
+def test_estimate_count_runs_under_the_timeout(rdb):
+    rdb.time_left = lambda: 2000
+    sql_statements = list()
+    execute = rdb.execute
+
+    def recorded(sql_statement, *args, **kwargs):
+        sql_statements.append(str(sql_statement))
+        return execute(sql_statement, *args, **kwargs)
+
+    rdb.execute = recorded
+    rdb.estimate_count(validate_query_params({'count': 'estimate'}))
+    assert sql_statements[0].startswith("SET LOCAL statement_timeout")
+    assert sql_statements[-1] == "RESET statement_timeout;"
@@ -0,0 +1,113 @@
+"""
+POST, PUT and DELETE bodies
+"""
+
+import pytest
+
+from actions import Action
+from exceptions import BadRequestError, NotFoundError
+
+TOOLS = {'id': 1, 'name': 'tools', 'description': 'hand tools'}
+PAINT = {'id': 2, 'name': 'paint', 'description': 'wall paint'}
+
+
+def products() -> list:
+    response = Action.get({'orderby': 'id', 'asc': True, 'limit': 100})
+    return [(row['id'], row['name'], row['category_id'], row['price'])
+            for row in response['result']]
+
+
+def categories() -> list:
+    response = Action.get({
+        'group_by': 'category_id,category_name', 'aggregates': 'count'})
+    return sorted(
+        (row['category_id'], row['category_name'], row['count'])
+        for row in response['result'])
+
+
+def test_insert_maps_body_category_ids(rdb):
+    Action.post({'categories': [TOOLS, PAINT]})
+    # the body category 1 is the category inserted along with the product
+    Action.post({
+        'categories': [{'id': 1, 'name': 'glue', 'description': 'glues'}],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 2, 'price': 10},
+            {'id': 1, 'name': 'epoxy', 'category_id': 1, 'price': 7},
+        ],
+    })
+    assert products() == [(1, 'hammer', 2, 10), (2, 'epoxy', 3, 7)]
+
+
+def test_insert_refuses_missing_category(rdb):
+    with pytest.raises(NotFoundError):
+        Action.post({'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 9, 'price': 10}]})
+    assert products() == []
+
+
+def test_update_changes_existing_rows_only(rdb):
+    Action.post({
+        'categories': [TOOLS],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 10}],
+    })
+    Action.put({'products': [
+        {'id': 1, 'name': 'mallet', 'category_id': 1, 'price': 12},
+        {'id': 5, 'name': 'saw', 'category_id': 1, 'price': 20},
+    ]})
+    assert products() == [(1, 'mallet', 1, 12)]
+
+
+def test_update_refuses_missing_category(rdb):
+    Action.post({
+        'categories': [TOOLS],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 10}],
+    })
+    with pytest.raises(NotFoundError):
+        Action.put({'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 9, 'price': 10}]})
+    assert products() == [(1, 'hammer', 1, 10)]
+
+
+def test_upsert_creates_missing_rows(rdb):
+    Action.put({
+        'upsert': True,
+        'categories': [TOOLS],
+        'products': [
+            {'id': 7, 'name': 'hammer', 'category_id': 1, 'price': 10}],
+    })
+    # the sequence moved past the explicit id
+    Action.post({'products': [
+        {'id': 1, 'name': 'saw', 'category_id': 1, 'price': 20}]})
+    assert products() == [(7, 'hammer', 1, 10), (8, 'saw', 1, 20)]
+
+
+def test_upsert_repeated_ids_keep_the_last_values(rdb):
+    Action.put({
+        'upsert': True,
+        'categories': [TOOLS, dict(TOOLS, name='hardware')],
+        'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 1, 'price': 10},
+            {'id': 1, 'name': 'mallet', 'category_id': 1, 'price': 12},
+        ],
+    })
+    assert products() == [(1, 'mallet', 1, 12)]
+    assert categories() == [(1, 'hardware', 1)]
+
+
+def test_upsert_refuses_missing_category(rdb):
+    with pytest.raises(NotFoundError):
+        Action.put({'upsert': True, 'products': [
+            {'id': 1, 'name': 'hammer', 'category_id': 9, 'price': 10}]})
+    assert products() == []
+
+
+@pytest.mark.parametrize('method, field, value', [
+    ('post', 'upsert', True),
+    ('delete', 'upsert', True),
+    ('post', 'continuation', 'token'),
+])
+def test_body_fields_of_other_methods_are_refused(rdb, method, field, value):
+    with pytest.raises(BadRequestError):
+        getattr(Action, method)({'categories': [TOOLS], field: value})
@@ -0,0 +1,132 @@
+"""
+This module contains per-phase latency tracing,
+emitted as one CloudWatch embedded metric format (EMF) line per invocation
+"""
+
+import os
+import json
+import time
+
+from functools import wraps
+
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AWS-Lambda-CRUD')
+
+
+class NullPhase:
+    """
+    shared no-op phase used while tracing is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase:
+    """
+    monotonic timer adding its duration to a metric
+    """
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.add(
+            self.name + '_ms',
+            (time.perf_counter() - self.start) * 1000,
+            'Milliseconds')
+        return False
+
+
+class Tracer:
+    """
+    collects metrics of one invocation
+    """
+
+    def __init__(self, enabled: bool = False,
+                 namespace: str = METRICS_NAMESPACE):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.metrics = dict()
+        self.units = dict()
+        self.properties = dict()
+        self.dimensions = list()
+
+    def start(self, **properties):
+        """
+        reset metrics, properties become the metric dimensions
+        """
+        self.metrics = dict()
+        self.units = dict()
+        self.properties = properties
+        self.dimensions = list(properties)
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def add(self, name: str, value, unit: str = 'Count'):
+        if not self.enabled:
+            return
+        self.metrics[name] = self.metrics.get(name, 0) + value
+        self.units[name] = unit
+
+    def set_property(self, name: str, value):
+        if self.enabled:
+            self.properties[name] = value
+
+    def emit(self):
+        """
+        print the invocation metrics as one EMF json line
+        """
+        if not self.enabled:
+            return
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [self.dimensions],
+                    'Metrics': [
+                        {'Name': name, 'Unit': unit}
+                        for name, unit in self.units.items()
+                    ],
+                }],
+            },
+            **self.properties,
+            **{name: round(value, 3) for name, value in self.metrics.items()},
+        }, default=str))
+
+
+tracer = Tracer(enabled=METRICS_ENABLED)
+
+
+def traced(name: str):
+    """
+    time every call of the decorated function as a phase,
+    functions are left untouched while tracing is disabled
+    """
+    def decorator(func):
+        if not tracer.enabled:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -6,12 +6,14 @@ using pydantic
 """
 
 
-import re
-import ast
+import os
+import json
+import base64
 
+from functools import lru_cache
 from typing import List, Tuple, Optional, Literal
 
-from pydantic import (BaseModel as BM, constr,
+from pydantic import (BaseModel as BM, constr, conlist,
                       ValidationError, PositiveInt,
                       NonNegativeInt, NonNegativeFloat,
                       model_validator, field_validator)
@@ -19,28 +21,88 @@ from pydantic import (BaseModel as BM, constr,
 from exceptions import BadRequestError
 
 
-or_filter_regex = r'\|(.*?)\*'
-and_filter_regex = r'&(.*?)\*'
+FILTER_CACHE_SIZE = int(os.environ.get('FILTER_CACHE_SIZE', 256))
 
+FILTER_SIDES = {
+    '&': 'and__',
+    '|': 'or__',
+}
 
-def list_to_dict(lst: list) -> dict:
+
+def parse_number(token: str):
     """
-    convert list filters to dict
+    int or float literal
     """
-    dct = dict()
     try:
-        for item in lst:
-            key_value = item.split('=')
-            _filter: str = key_value[0]
-            _val: str = key_value[1]
-            if _filter.endswith('__in') or \
-                    _filter.endswith('__nin'):
-                dct[_filter] = ast.literal_eval(_val)
-            else:
-                dct[_filter] = _val
-        return dct
-    except Exception as e:
-        raise BadRequestError(error_message=e)
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def parse_sequence(text: str) -> tuple:
+    """
+    parse a literal list like (1,2) or ('a', "b") without eval
+    """
+    text = text.strip()
+    if len(text) >= 2 and (text[0], text[-1]) in (('(', ')'), ('[', ']')):
+        text = text[1:-1]
+    items = list()
+    i, n = 0, len(text)
+    while i < n:
+        char = text[i]
+        if char.isspace():
+            i += 1
+            continue
+        if char in ('"', "'"):
+            chars = list()
+            i += 1
+            while i < n and text[i] != char:
+                if text[i] == '\\' and i + 1 < n:
+                    i += 1
+                chars.append(text[i])
+                i += 1
+            if i >= n:
+                raise ValueError("unterminated string literal")
+            items.append(''.join(chars))
+            i += 1
+        else:
+            end = text.find(',', i)
+            if end == -1:
+                end = n
+            items.append(parse_number(text[i:end].strip()))
+            i = end
+        while i < n and text[i].isspace():
+            i += 1
+        if i < n:
+            if text[i] != ',':
+                raise ValueError(f"unexpected {text[i]!r} in list")
+            i += 1
+    return tuple(items)
+
+
+def tokenize_filters(filters: str) -> tuple:
+    """
+    split &key=value* and |key=value* items in a single pass
+    """
+    sides = {'&': dict(), '|': dict()}
+    i, n = 0, len(filters)
+    while i < n:
+        char = filters[i]
+        if char not in FILTER_SIDES:
+            i += 1
+            continue
+        end = filters.find('*', i + 1)
+        if end == -1:
+            break
+        _filter, sep, _val = filters[i + 1:end].partition('=')
+        if not sep:
+            raise ValueError(f"missing value for {_filter!r}")
+        if _filter.endswith('__in') or _filter.endswith('__nin'):
+            sides[char][_filter] = parse_sequence(_val)
+        else:
+            sides[char][_filter] = _val
+        i = end + 1
+    return sides['&'], sides['|']
 
 
 class BaseModel(BM, extra='forbid'):
@@ -70,7 +132,7 @@ class Product(BaseModel):
     id: PositiveInt
     name: constr(strip_whitespace=True,
                  min_length=1,
-                 regex=r"[a-zA-Z]")
+                 pattern=r"[a-zA-Z]")
     category_id: PositiveInt
     price: NonNegativeFloat
 
@@ -82,11 +144,11 @@ class Category(BaseModel):
     id: PositiveInt
     name: constr(strip_whitespace=True,
                  min_length=1,
-                 regex=r"[a-zA-Z]")
+                 pattern=r"[a-zA-Z]")
     description: constr(strip_whitespace=True,
                         min_length=1,
                         max_length=255,
-                        regex=r"[a-zA-Z]",)
+                        pattern=r"[a-zA-Z]",)
 
 
 class Body(BaseModel):
@@ -104,6 +166,39 @@ class Body(BaseModel):
         return self
 
 
+class DeleteBody(Body):
+    """
+    model for DELETE request body
+    """
+    # resumes a chunked request where it stopped
+    continuation: Optional[str] = None
+
+
+class PutBody(DeleteBody):
+    """
+    model for PUT request body
+    """
+    # create rows whose id does not exist yet
+    upsert: Optional[bool] = False
+
+
+class Operation(BaseModel):
+    """
+    model for one operation of a batch request
+    """
+    method: Literal['GET', 'POST', 'PUT', 'DELETE']
+    body: Optional[dict] = None
+    queryParams: Optional[dict] = None
+
+
+class Batch(BaseModel):
+    """
+    model for batch request body
+    """
+    operations: conlist(Operation, min_length=1, max_length=100)
+    atomic: Optional[bool] = True
+
+
 class QueryParam(BaseModel):
     """
     model for request query params
@@ -116,8 +211,26 @@ class QueryParam(BaseModel):
         'name',
         'category_id',
         'price',
+        'rank',
     ]] = 'price'
     asc: Optional[bool] = False
+    pagination: Optional[Literal[
+        'offset',
+        'cursor',
+    ]] = 'offset'
+    cursor: Optional[str] = None
+    format: Optional[Literal[
+        'json',
+        'ndjson',
+        'columnar',
+    ]] = 'json'
+    count: Optional[Literal[
+        'exact',
+        'estimate',
+    ]] = None
+    fields: Optional[str] = None
+    group_by: Optional[str] = None
+    aggregates: Optional[str] = None
 
 
 class Filter(BaseModel):
@@ -138,6 +251,7 @@ class Filter(BaseModel):
     name__like: Optional[str] = None
     name__ne: Optional[str] = None
     name__nin: Optional[Tuple[str, ...]] = None
+    name__search: Optional[str] = None
 
     category_id__eq: Optional[PositiveInt] = None
     category_id__gt: Optional[PositiveInt] = None
@@ -168,6 +282,7 @@ class Filter(BaseModel):
     description__like: Optional[str] = None
     description__ne: Optional[str] = None
     description__nin: Optional[Tuple[str, ...]] = None
+    description__search: Optional[str] = None
 
     @field_validator('name__like', 'category_name__like', 'description__like')
     @classmethod
@@ -175,31 +290,145 @@ class Filter(BaseModel):
         return f'%{v}%'
 
 
+def encode_cursor(orderby: str, value, _id: int) -> str:
+    """
+    opaque keyset cursor for the row a page ended on
+    """
+    raw = json.dumps([orderby, value, _id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str, orderby: str) -> tuple:
+    """
+    to read (orderby value, id) back from a keyset cursor
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        _orderby, value, _id = json.loads(raw)
+    except Exception:
+        raise BadRequestError(error_message="Invalid cursor!")
+    if _orderby != orderby or not isinstance(_id, int):
+        raise BadRequestError(
+            error_message="Cursor does not match the requested ordering!")
+    return value, _id
+
+
+def encode_continuation(step: int, offset: int, digest: str) -> str:
+    """
+    opaque token of where a chunked write stopped
+    """
+    raw = json.dumps([step, offset, digest], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_continuation(continuation: str, digest: str) -> tuple:
+    """
+    to read (step, offset) back from a continuation token
+    """
+    try:
+        raw = base64.urlsafe_b64decode(continuation.encode('ascii'))
+        step, offset, _digest = json.loads(raw)
+    except Exception:
+        raise BadRequestError(error_message="Invalid continuation!")
+    if _digest != digest or not isinstance(step, int) or \
+            not isinstance(offset, int):
+        raise BadRequestError(
+            error_message="Continuation does not match the request body!")
+    return step, offset
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def parse_filters(filters: str) -> dict:
+    """
+    validated and normalized and/or filters of a filters string,
+    memoized because clients repeat the same strings,
+    the returned dict is shared and must not be mutated
+    """
+    try:
+        _and_filters, _or_filters = tokenize_filters(filters)
+        and_filters: dict = Filter(
+            **_and_filters).model_dump(exclude_none=True)
+        or_filters: dict = Filter(
+            **_or_filters).model_dump(exclude_none=True)
+    except Exception as e:
+        raise BadRequestError(
+            error_message="Invalid Query Parameters!")
+    parsed = {'and__'+k: v for k, v in and_filters.items()}
+    parsed.update({'or__'+k: v for k, v in or_filters.items()})
+    return parsed
+
+
+FIELDS = (
+    'id',
+    'name',
+    'category_id',
+    'price',
+    'category_name',
+    'description',
+)
+
+
+GROUP_BY_FIELDS = (
+    'category_id',
+    'category_name',
+)
+
+AGGREGATES = (
+    'count',
+    'sum',
+    'min',
+    'max',
+    'avg',
+)
+
+
+def parse_fields(fields: str, allowed: tuple = FIELDS) -> tuple:
+    """
+    comma separated names, in the requested order
+    """
+    parsed = list()
+    for field in fields.split(','):
+        field = field.strip()
+        if field not in allowed:
+            raise BadRequestError(
+                error_message=f"Unknown field '{field}'!")
+        if field not in parsed:
+            parsed.append(field)
+    return tuple(parsed)
+
+
 def validate_query_params(query_params: dict) -> dict:
     """
     to validate query params
     """
     query_params: dict = QueryParam(
         **query_params).model_dump(exclude_none=True)
-    filters = query_params.get('filters', None)
+    filters = query_params.pop('filters', None)
     if filters:
-        try:
-            _and_filters = re.findall(and_filter_regex, filters)
-            _or_filters = re.findall(or_filter_regex, filters)
-            and_filters: dict = Filter(
-                **list_to_dict(_and_filters)).model_dump(exclude_none=True)
-            and_filters = {
-                'and__'+k: v for k, v in and_filters.items()
-            }
-            or_filters: dict = Filter(
-                **list_to_dict(_or_filters)).model_dump(exclude_none=True)
-            or_filters = {
-                'or__'+k: v for k, v in or_filters.items()
-            }
-            query_params.pop('filters')
-            query_params.update(and_filters)
-            query_params.update(or_filters)
-        except Exception as e:
+        query_params.update(parse_filters(filters))
+    if 'fields' in query_params:
+        query_params['fields'] = parse_fields(query_params['fields'])
+    if 'group_by' in query_params:
+        query_params['group_by'] = parse_fields(
+            query_params['group_by'], GROUP_BY_FIELDS)
+        query_params.setdefault('aggregates', 'count')
+    if 'aggregates' in query_params:
+        query_params['aggregates'] = parse_fields(
+            query_params['aggregates'], AGGREGATES)
+    if query_params['format'] == 'ndjson':
+        # exports resume from their continuation cursor
+        query_params['pagination'] = 'cursor'
+    cursor = query_params.pop('cursor', None)
+    if cursor:
+        query_params['pagination'] = 'cursor'
+    if query_params['orderby'] == 'rank':
+        if not any(k.endswith('__search') for k in query_params):
+            raise BadRequestError(
+                error_message="orderby=rank needs a __search filter!")
+        if query_params['pagination'] == 'cursor':
             raise BadRequestError(
-                error_message="Invalid Query Parameters!")
+                error_message="orderby=rank does not support cursors!")
+    if cursor:
+        query_params['cursor_value'], query_params['cursor_id'] = \
+            decode_cursor(cursor, query_params['orderby'])
     return query_params